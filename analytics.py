@@ -0,0 +1,108 @@
+# ==============================================================================
+# analytics.py
+# ==============================================================================
+# stock_history の「使用」行から、商品ごとの1日あたり・1週間あたりの使用量、移動平均、
+# 在庫が無くなるまでの見込み日数を求める。
+# 商品 × 日付ごとの使用量の合計をキャッシュしておき、新しく追記された履歴行の分だけを
+# 足し込む (reconcile.py と同じく、前回集計した最終行の id で読み直しを検出する)。
+# 集計はアーカイブされていない履歴 (既定で直近180日) が対象になる。
+import threading
+import numpy as np
+import pandas as pd
+import database
+
+USAGE_CHANGE_TYPES = ['使用']
+DEFAULT_WINDOW_DAYS = 28   # 平均使用量を求める期間 (日)
+TREND_WINDOW_DAYS = 7      # 推移グラフの移動平均の幅 (日)
+
+_state_lock = threading.Lock()
+_state = {
+    "rows": 0,          # 集計済みの履歴行数
+    "last_id": None,    # 集計済みの最終行の id
+    # (product_id, date) を索引とする使用量の合計
+    "daily": pd.Series(dtype='int64', index=pd.MultiIndex.from_arrays(
+        [pd.Index([], dtype=object), pd.DatetimeIndex([])], names=['product_id', 'date'])),
+}
+
+
+def _today():
+    return database._parse_timestamp(database._now_jst()).date()
+
+
+def daily_totals(records):
+    """履歴行から、使用量の (product_id, date) ごとの合計を Series で返します。"""
+    if not records:
+        return _state["daily"].iloc[:0]
+    df = pd.DataFrame.from_records(records, columns=['product_id', 'change_type', 'quantity', 'timestamp'])
+    df = df[df['change_type'].isin(USAGE_CHANGE_TYPES)]
+    df = df.assign(
+        product_id=df['product_id'].astype(str),
+        quantity=pd.to_numeric(df['quantity'], errors='coerce').fillna(0).astype('int64'),
+        # シートの表示形式によっては 2025/04/01 のような区切りで返ってくる
+        date=pd.to_datetime(df['timestamp'].astype(str).str.replace('/', '-', regex=False),
+                            format='%Y-%m-%d %H:%M:%S', errors='coerce').dt.normalize(),
+    )
+    df = df[(df['product_id'] != '') & df['date'].notna()]
+    return df.groupby(['product_id', 'date'])['quantity'].sum()
+
+
+def daily_usage(refresh=True):
+    """(product_id, date) ごとの使用量の合計を返します。前回から追記された行だけを集計します。"""
+    records = database.get_history_records(refresh)
+    with _state_lock:
+        start = _state["rows"]
+        if start > len(records) or (start and str(records[start - 1].get('id')) != _state["last_id"]):
+            start = 0
+        new_totals = daily_totals(records[start:])
+        if start:
+            daily = _state["daily"].add(new_totals, fill_value=0).astype('int64')
+        else:
+            daily = new_totals
+        _state.update(rows=len(records), last_id=str(records[-1].get('id')) if records else None, daily=daily)
+        return daily
+
+
+def usage_report(products, window_days=DEFAULT_WINDOW_DAYS, refresh=True, today=None):
+    """商品ごとの使用量と在庫切れの見込みを DataFrame で返します (在庫切れが早い順)。
+
+    列: id, product_code, name, current_stock, used_7d, used_window, avg_daily_7d, avg_daily,
+    avg_weekly, days_to_stockout, stockout_date
+    avg_daily は直近 window_days 日の1日あたり平均で、days_to_stockout はこれで在庫を割った日数です
+    (使用が無い商品は inf)。
+    """
+    today = pd.Timestamp(today or _today())
+    daily = daily_usage(refresh)
+    age_days = (today - daily.index.get_level_values('date')).days
+    product_ids = daily.index.get_level_values('product_id')
+    in_window = (age_days >= 0) & (age_days < window_days)
+    in_week = (age_days >= 0) & (age_days < 7)
+    used_window = daily[in_window].groupby(product_ids[in_window]).sum()
+    used_7d = daily[in_week].groupby(product_ids[in_week]).sum()
+
+    report = pd.DataFrame(list(products), columns=['id', 'product_code', 'name', 'current_stock'])
+    keys = report['id'].astype(str)
+    report['current_stock'] = pd.to_numeric(report['current_stock'], errors='coerce').fillna(0).astype('int64')
+    report['used_7d'] = keys.map(used_7d).fillna(0).astype('int64')
+    report['used_window'] = keys.map(used_window).fillna(0).astype('int64')
+    report['avg_daily_7d'] = report['used_7d'] / 7
+    report['avg_daily'] = report['used_window'] / window_days
+    report['avg_weekly'] = report['avg_daily'] * 7
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days = np.where(report['avg_daily'] > 0, report['current_stock'].clip(lower=0) / report['avg_daily'], np.inf)
+    report['days_to_stockout'] = days
+    finite = np.isfinite(days)
+    report['stockout_date'] = pd.NaT
+    report.loc[finite, 'stockout_date'] = today + pd.to_timedelta(np.floor(days[finite]), unit='D')
+    return report.sort_values(['days_to_stockout', 'avg_daily'], ascending=[True, False]).reset_index(drop=True)
+
+
+def usage_trend(product_ids=None, days=90, window=TREND_WINDOW_DAYS, refresh=True, today=None):
+    """日付 × 商品の1日あたり使用量の移動平均 (window 日) を、直近 days 日分の DataFrame で返します。"""
+    today = pd.Timestamp(today or _today())
+    daily = daily_usage(refresh)
+    if product_ids is not None:
+        daily = daily[daily.index.get_level_values('product_id').isin([str(p) for p in product_ids])]
+    # 移動平均の最初の日にも前の window 日分が入るよう、その分だけ前から並べる
+    index = pd.date_range(today - pd.Timedelta(days=days + window - 2), today, freq='D', name='date')
+    table = daily.unstack('product_id', fill_value=0).reindex(index, fill_value=0)
+    return table.rolling(window, min_periods=1).mean().iloc[window - 1:]
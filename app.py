@@ -2,23 +2,31 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import database
+import journal
+import reconcile
+import archive
+import analytics
+import labels
+import metrics
+import export
 import pandas as pd
-import qrcode
-import io
 import bcrypt
 from streamlit_webrtc import webrtc_streamer, WebRtcMode
-import cv2
-from urllib.parse import urlparse, parse_qs
 import os # osライブラリを追加
 import yaml # yamlライブラリを追加
 from yaml.loader import SafeLoader # SafeLoaderを追加
-import av # カメラのフレームを扱うために追加
+from qr_scanner import QrScanner, SAMPLE_EVERY, MAX_SIDE, DEBOUNCE_SECONDS
 
 # --- データベースの準備（変更なし） ---
 database.init_db()
 
 # --- ページタイトルの設定 ---
 st.set_page_config(page_title="安田研究室 消耗品管理システム", layout="wide")
+# 再実行ごとの処理時間の計測 (管理者メニューで有効にしたときだけ)
+metrics.start_rerun()
+
+# --- 使用記録ジャーナルの反映ワーカーを起動 (前回の未反映分があれば反映する) ---
+journal.start()
 
 # --- ▼▼▼ 登録成功時のメッセージ表示ロジックを追加 ▼▼▼ ---
 if st.session_state.get("just_registered"):
@@ -50,6 +58,8 @@ if 'authentication_status' not in st.session_state:
 if 'name' not in st.session_state:
     st.session_state.name = None
 
+metrics.mark('準備')
+
 # --- ログイン成功時のメイン処理 ---
 if st.session_state["authentication_status"]:
     name = st.session_state["name"]
@@ -73,8 +83,14 @@ if st.session_state["authentication_status"]:
             st.session_state.admin_unlocked = False
             st.rerun()
 
+        # 履歴シートが大きくなっていれば、バックグラウンドで古い行をアーカイブへ移す (1日に1回まで確認)
+        archive.maybe_archive()
+        # このページで使うデータは最初に1回でまとめて読み込み、各セクションで共有する
+        page_data = database.load_admin_page_data()
+        metrics.mark('管理者: データ読み込み')
+        all_products_list = journal.with_pending(page_data["products"])
+
         st.subheader('在庫数の手動更新(入荷、棚卸しなど)')
-        all_products_list = database.get_all_products()
         product_options = {f"{p['name']} ({p['product_code']})": p['id'] for p in all_products_list}
         
         if product_options:
@@ -85,26 +101,78 @@ if st.session_state["authentication_status"]:
 
                 if submit_button and quantity_change != 0:
                     product_id = product_options[selected_product_display_name]
-                    database.update_stock(product_id, quantity_change)
                     change_type = '入荷' if quantity_change > 0 else '棚卸調整'
-                    database.add_stock_history(product_id, name, change_type, abs(quantity_change))
+                    database.adjust_stock(product_id, quantity_change, name, change_type)
                     st.success(f"「{selected_product_display_name}」の在庫数を更新しました。")
                     st.rerun()
+            with st.expander('複数の品目をまとめて更新（納品時の入荷登録など）'):
+                bulk_df = pd.DataFrame({'品目': list(product_options.keys()), '数量の変更': 0})
+                # 更新後に入力内容を消すため、更新のたびに別のキーで作り直す
+                bulk_editor_key = f"bulk_stock_editor_{st.session_state.get('bulk_editor_version', 0)}"
+                edited_bulk_df = st.data_editor(bulk_df, disabled=['品目'], hide_index=True, use_container_width=True, key=bulk_editor_key)
+                if st.button('まとめて在庫数を更新'):
+                    # 消したセルは NaN になるので 0 (変更なし) として扱う
+                    edited_bulk_df = edited_bulk_df.fillna({'数量の変更': 0})
+                    changes = [(product_options[row['品目']], int(row['数量の変更'])) for row in edited_bulk_df.to_dict('records') if row['数量の変更']]
+                    if changes:
+                        history_rows = [database.new_history_row(product_id, name, '入荷' if change > 0 else '棚卸調整', abs(change)) for product_id, change in changes]
+                        database.apply_stock_changes(changes, history_rows)
+                        st.session_state.bulk_editor_version = st.session_state.get('bulk_editor_version', 0) + 1
+                        st.success(f"{len(changes)}品目の在庫数を更新しました。")
+                        st.rerun()
         else:
             st.write('更新対象の商品がありません')
         
+        metrics.mark('管理者: 在庫数の手動更新')
         st.subheader('現在の在庫一覧')
         if all_products_list:
+            # シートの列の並び・数に依存しないよう、列名で選ぶ
             df_products = pd.DataFrame(all_products_list)
-            df_products.columns = ['id', 'product_code', 'name', 'unit', 'current_stock', 'created_at']
-            df_display = df_products[['product_code', 'name', 'current_stock', 'unit']]
-            df_display.columns = ['商品コード', '品目名', '現在庫数', '単位']
+            df_display = df_products.reindex(columns=['product_code', 'name', 'current_stock', 'unit', database.REORDER_THRESHOLD_HEADER])
+            df_display.columns = ['商品コード', '品目名', '現在庫数', '単位', '発注点']
             st.dataframe(df_display, use_container_width=True)
         else:
             st.write('商品はまだ登録されていません。')
+
+        st.subheader('在庫が少ない品目（発注点以下）')
+        low_stock_products = database.get_low_stock_products()
+        if low_stock_products:
+            df_low_stock = pd.DataFrame(low_stock_products).reindex(columns=['product_code', 'name', 'current_stock', database.REORDER_THRESHOLD_HEADER, 'unit'])
+            df_low_stock.columns = ['商品コード', '品目名', '現在庫数', '発注点', '単位']
+            st.dataframe(df_low_stock, use_container_width=True)
+        else:
+            st.write('発注点以下の品目はありません。')
+        if all_products_list:
+            with st.expander('発注点を設定する'):
+                threshold_df = pd.DataFrame({
+                    '品目': [f"{p['name']} ({p['product_code']})" for p in all_products_list],
+                    '発注点': [pd.to_numeric(p.get(database.REORDER_THRESHOLD_HEADER), errors='coerce') for p in all_products_list],
+                })
+                threshold_editor_key = f"threshold_editor_{st.session_state.get('threshold_editor_version', 0)}"
+                edited_threshold_df = st.data_editor(threshold_df, disabled=['品目'], hide_index=True, use_container_width=True, key=threshold_editor_key,
+                                                     column_config={'発注点': st.column_config.NumberColumn(min_value=0, step=1, help="在庫数がこの値以下になると「在庫が少ない品目」に表示されます。空欄なら対象外です。")})
+                if st.button('発注点を保存'):
+                    thresholds = {}
+                    for before, after in zip(threshold_df.to_dict('records'), edited_threshold_df.to_dict('records')):
+                        before_value = None if pd.isna(before['発注点']) else int(before['発注点'])
+                        after_value = None if pd.isna(after['発注点']) else int(after['発注点'])
+                        if before_value != after_value:
+                            thresholds[product_options[after['品目']]] = after_value
+                    if thresholds:
+                        database.set_reorder_thresholds(thresholds)
+                        st.session_state.threshold_editor_version = st.session_state.get('threshold_editor_version', 0) + 1
+                        st.success(f"{len(thresholds)}品目の発注点を保存しました。")
+                        st.rerun()
         
+        metrics.mark('管理者: 在庫一覧・発注点')
         st.subheader('使用履歴')
-        all_history = database.get_all_history()
+        filter_cols = st.columns(3)
+        history_limit = filter_cols[0].number_input('表示件数（新しい順）', min_value=10, max_value=10000, value=100, step=50)
+        history_dates = filter_cols[1].date_input('期間', value=(), help="開始日と終了日を選ぶと、その期間の履歴だけを表示します。")
+        history_user = filter_cols[2].text_input('使用者で絞り込み')
+        start_date = history_dates[0] if len(history_dates) > 0 else None
+        end_date = history_dates[1] if len(history_dates) > 1 else start_date
+        all_history = database.get_history(limit=history_limit, start_date=start_date, end_date=end_date, user_name=history_user.strip() or None, refresh=False)
         if all_history:
             df_full_history = pd.DataFrame(all_history)
             df_display_history = df_full_history[['timestamp', 'user_name', 'name', 'change_type', 'quantity']]
@@ -112,23 +180,138 @@ if st.session_state["authentication_status"]:
             st.dataframe(df_display_history, use_container_width=True)
         else:
             st.write('使用履歴がありません。')
-        
+        with st.expander('使用履歴をファイルに書き出す（CSV / Parquet）'):
+            export_cols = st.columns(3)
+            export_dates = export_cols[0].date_input('書き出す期間', value=(), key='export_dates', help="空欄ならすべての期間（アーカイブを含む）を書き出します。")
+            export_product_labels = {f"{p['name']} ({p['product_code']})": p['id'] for p in all_products_list}
+            export_products = export_cols[1].multiselect('品目で絞り込み', options=list(export_product_labels.keys()))
+            export_format = export_cols[2].radio('形式', ['csv', 'parquet'], horizontal=True, format_func=str.upper)
+            export_job_id = st.session_state.get('export_job_id')
+            export_job = export.get_job(export_job_id) if export_job_id else None
+            if st.button('書き出しを開始', disabled=bool(export_job and not export_job['done'])):
+                if export_job_id:
+                    export.discard_job(export_job_id)
+                st.session_state.export_job_id = export.start_export(
+                    export_format,
+                    start_date=export_dates[0] if len(export_dates) > 0 else None,
+                    end_date=export_dates[1] if len(export_dates) > 1 else (export_dates[0] if export_dates else None),
+                    product_ids={export_product_labels[label] for label in export_products} or None,
+                )
+                st.rerun()
+            if export_job and not export_job['done']:
+                st.info(f"書き出し中です（{export_job['rows']}行）。")
+                st.button('状況を更新')
+            elif export_job and export_job['error']:
+                st.error(f"書き出しに失敗しました: {export_job['error']}")
+            elif export_job:
+                with open(export_job['path'], 'rb') as export_file:
+                    st.download_button(f"ダウンロード（{export_job['rows']}行、{export_job['format'].upper()}）", export_file.read(),
+                                       file_name=f"stock_history.{export_job['format']}", mime=export.FORMATS[export_job['format']])
+
+        metrics.mark('管理者: 使用履歴')
+        st.subheader('使用量の分析と在庫切れの見込み')
+        if all_products_list:
+            window_days = st.select_slider('平均使用量を求める期間（日）', options=[7, 14, 28, 56, 90], value=analytics.DEFAULT_WINDOW_DAYS)
+            usage_report = analytics.usage_report(all_products_list, window_days=window_days, refresh=False)
+            df_usage = usage_report[['product_code', 'name', 'current_stock', 'used_7d', 'avg_daily', 'avg_weekly', 'days_to_stockout', 'stockout_date']].copy()
+            df_usage['days_to_stockout'] = df_usage['days_to_stockout'].replace(float('inf'), None)
+            df_usage.columns = ['商品コード', '品目名', '現在庫数', '直近7日の使用数', '1日あたり使用数', '1週間あたり使用数', '在庫切れまでの日数', '在庫切れ見込み日']
+            st.dataframe(df_usage, use_container_width=True, column_config={
+                '1日あたり使用数': st.column_config.NumberColumn(format="%.2f"),
+                '1週間あたり使用数': st.column_config.NumberColumn(format="%.1f"),
+                '在庫切れまでの日数': st.column_config.NumberColumn(format="%.0f"),
+                '在庫切れ見込み日': st.column_config.DateColumn(format="YYYY-MM-DD"),
+            })
+            trend_products = st.multiselect('使用量の推移（7日移動平均）を表示する品目', options=usage_report['id'].tolist(), format_func=dict(zip(usage_report['id'], usage_report['name'])).get)
+            if trend_products:
+                trend = analytics.usage_trend(trend_products, refresh=False)
+                st.line_chart(trend.rename(columns={str(p['id']): p['name'] for p in all_products_list}))
+
+        metrics.mark('管理者: 使用量の分析')
+        st.subheader('在庫の検算（使用履歴との突き合わせ）')
+        if st.button('使用履歴から在庫数を検算する'):
+            st.session_state.reconcile_report = reconcile.reconcile()
+        reconcile_report = st.session_state.get('reconcile_report')
+        if reconcile_report is not None:
+            df_diff = reconcile_report[reconcile_report['difference'] != 0]
+            if df_diff.empty:
+                st.success('使用履歴と在庫数は一致しています。')
+            else:
+                df_diff_display = df_diff[['product_code', 'name', 'current_stock', 'expected_stock', 'difference', 'has_snapshot']]
+                df_diff_display.columns = ['商品コード', '品目名', '現在庫数', '履歴上の在庫数', '差', '起点あり']
+                st.dataframe(df_diff_display, use_container_width=True)
+                if st.button('差分を修正する（起点のある品目のみ）'):
+                    corrected = reconcile.apply_corrections(reconcile_report, name)
+                    del st.session_state['reconcile_report']
+                    st.success(f"{corrected}品目の在庫数を修正しました。")
+                    st.rerun()
+        if st.button('現在の在庫数を検算の起点として記録する', help="全品目の現在庫数をスナップショットとして使用履歴に記録します。以降の検算はこの時点から行います。"):
+            reconcile.write_snapshots(name)
+            st.session_state.pop('reconcile_report', None)
+            st.success('現在の在庫数を記録しました。')
+
+        if database.STORAGE_BACKEND != "sqlite":
+            st.subheader('使用履歴のアーカイブ')
+            archive_days = st.number_input('この日数より古い履歴をアーカイブへ移す', min_value=30, max_value=3650, value=int(database.get_setting("archive_after_days", archive.ARCHIVE_AFTER_DAYS)), step=30)
+            if st.button('古い使用履歴をアーカイブする', help="古い行を月ごとのアーカイブ用シートへ移し、品目ごとの繰越行を残します。期間を指定した履歴の表示では、アーカイブも合わせて表示されます。"):
+                archived_count = archive.archive_history(archive_days)
+                st.success(f"{archived_count}行をアーカイブしました。")
+
+        metrics.mark('管理者: 検算・アーカイブ')
         st.subheader('QRコード生成')
         if all_products_list:
             base_url = st.text_input("アプリのベースURLを入力", "https://ouyasudalab-stock.streamlit.app", help="デプロイ後に発行される、このアプリのURLを入力してください。")
             product_for_qr = st.selectbox(label="QRコードを生成する備品を選択", options=[f"{p['name']} ({p['product_code']})" for p in all_products_list], index=None, placeholder="備品を選択してください...")
             if product_for_qr:
                 selected_code = product_for_qr.split('(')[-1].replace(')', '')
-                url_to_encode = f"{base_url}?product_code={selected_code}"
+                url_to_encode = labels.product_url(base_url, selected_code)
                 st.write("生成されたURL:")
                 st.code(url_to_encode)
-                qr_img = qrcode.make(url_to_encode)
-                buf = io.BytesIO()
-                qr_img.save(buf, format='PNG')
-                img_bytes = buf.getvalue()
+                # 同じ URL の画像は作り直さない
+                img_bytes = labels.qr_png(base_url, selected_code)
                 st.image(img_bytes, caption=f"{product_for_qr} のQRコード", width=200)
                 st.info("この画像を右クリックして保存し、印刷して使用してください。")
+
+            with st.expander('QRラベルの台紙をまとめて作成（印刷用）'):
+                label_options = {f"{p['name']} ({p['product_code']})": p for p in all_products_list}
+                label_selection = st.multiselect('ラベルを作る備品（空欄ならすべて）', options=list(label_options.keys()))
+                label_cols = st.columns(3)
+                label_columns = label_cols[0].number_input('横の枚数', min_value=1, max_value=8, value=labels.DEFAULT_COLUMNS)
+                label_rows = label_cols[1].number_input('縦の枚数', min_value=1, max_value=12, value=labels.DEFAULT_ROWS)
+                label_format = label_cols[2].radio('形式', ['PDF', 'PNG'], horizontal=True)
+                if st.button('ラベルの台紙を作成'):
+                    label_products = [label_options[key] for key in label_selection] or all_products_list
+                    st.session_state.label_sheet = (labels.label_sheet(label_products, base_url, label_format, label_columns, label_rows), label_format, len(label_products))
+                if st.session_state.get('label_sheet'):
+                    sheet_bytes, sheet_format, sheet_count = st.session_state.label_sheet
+                    st.download_button(f"台紙をダウンロード（{sheet_count}品目、{sheet_format}）", sheet_bytes,
+                                       file_name=f"qr_labels.{sheet_format.lower()}", mime="application/pdf" if sheet_format == 'PDF' else "image/png")
         
+        metrics.mark('管理者: QRコード')
+        st.subheader('Sheets API の呼び出し状況')
+        calls_last_minute, quota = metrics.calls_last_minute(), metrics.quota_per_minute()
+        st.metric('直近1分間の呼び出し回数', f"{calls_last_minute} / {quota} 回")
+        st.progress(min(calls_last_minute / quota, 1.0))
+        api_summary = metrics.summary()
+        if api_summary:
+            df_api = pd.DataFrame(api_summary)[['op', 'caller', 'count', 'errors', 'avg_ms', 'max_ms', 'cells']]
+            df_api.columns = ['操作', '呼び出し元', '回数', 'エラー', '平均 (ms)', '最大 (ms)', 'セル数']
+            st.dataframe(df_api, use_container_width=True)
+        slow_calls = metrics.recent_calls(slow_only=True)
+        if slow_calls:
+            st.write('遅かった呼び出し（新しい順）')
+            df_slow = pd.DataFrame(slow_calls)
+            df_slow['time'] = pd.to_datetime(df_slow['time'], unit='s', utc=True).dt.tz_convert('Asia/Tokyo').dt.strftime('%Y-%m-%d %H:%M:%S')
+            df_slow = df_slow[['time', 'target', 'op', 'caller', 'ms', 'status']]
+            df_slow.columns = ['日時', 'シート', '操作', '呼び出し元', '所要時間 (ms)', '結果']
+            st.dataframe(df_slow, use_container_width=True)
+        st.toggle('再実行ごとの処理時間を計測する', key='profile_reruns', value=metrics.profiling_enabled())
+        rerun_profile = metrics.last_rerun_profile()
+        if metrics.profiling_enabled() and rerun_profile:
+            df_profile = pd.DataFrame(rerun_profile)
+            df_profile.columns = ['処理', '所要時間 (ms)', 'API 呼び出し (このセッション)']
+            st.dataframe(df_profile, use_container_width=True)
+
         st.divider()
         st.subheader('データベース本体')
         st.link_button("Googleスプレッドシートで在庫を直接編集する", "https://docs.google.com/spreadsheets/d/1kFw-RGElLZOLtMmijTRExBAKcSJ2yiqLR0BuqAF8G1c/edit")
@@ -152,43 +335,86 @@ if st.session_state["authentication_status"]:
         if 'scanned_code' not in st.session_state:
             st.session_state.scanned_code = None
 
-        def qr_code_callback(frame: av.VideoFrame) -> av.VideoFrame:
-            img = frame.to_ndarray(format="bgr24")
-            height, width, _ = img.shape
-            box_size = min(width, height) * 2 // 3
-            x_start = (width - box_size) // 2
-            y_start = (height - box_size) // 2
-            cv2.rectangle(img, (x_start, y_start), (x_start + box_size, y_start + box_size), (0, 255, 0), 2)
-            qr_detector = cv2.QRCodeDetector()
-            data, _, _ = qr_detector.detectAndDecode(img)
-            if data:
-                try:
-                    parsed_url = urlparse(data)
-                    query_params = parse_qs(parsed_url.query)
-                    if 'product_code' in query_params:
-                        st.session_state.scanned_code = query_params['product_code'][0]
-                except Exception:
-                    pass
-            return av.VideoFrame.from_ndarray(img, format="bgr24")
-
-        webrtc_streamer(
+        # 読み取り器はセッション (= カメラ映像) ごとに1つ作り、再実行をまたいで使い回す
+        if 'qr_scanner' not in st.session_state:
+            st.session_state.qr_scanner = QrScanner(
+                sample_every=database.get_setting("qr_sample_every", SAMPLE_EVERY),
+                max_side=database.get_setting("qr_max_side", MAX_SIDE),
+                debounce_seconds=database.get_setting("qr_debounce_seconds", DEBOUNCE_SECONDS),
+            )
+        qr_scanner = st.session_state.qr_scanner
+
+        webrtc_ctx = webrtc_streamer(
             key="qr-scanner",
             mode=WebRtcMode.SENDONLY,
-            video_frame_callback=qr_code_callback,
+            video_frame_callback=qr_scanner,
             media_stream_constraints={"video": {"facingMode": "environment"}, "audio": False},
             async_processing=True,
         )
 
+        scanned_code = qr_scanner.pop_code()
+        if scanned_code:
+            st.session_state.scanned_code = scanned_code
+
         st.markdown("---")
+
+        # --- まとめて登録モード: スキャンした品目をかごに入れ、最後に一度で登録する ---
+        if 'basket' not in st.session_state:
+            st.session_state.basket = {}
+        basket = st.session_state.basket
+        # モードも入力欄と同じく、管理者ページを表示すると消されるので別のキーに持つ
+        basket_mode = st.toggle('まとめて登録モード（複数の品目をスキャンしてから一度に登録）', value=st.session_state.get('basket_mode_on', False), key='basket_mode')
+        st.session_state.basket_mode_on = basket_mode
         
         active_product_code = st.session_state.get("scanned_code") or st.query_params.get("product_code")
 
+        if active_product_code and basket_mode:
+            product = database.get_product_by_code(active_product_code)
+            if product:
+                if active_product_code in basket:
+                    basket[active_product_code]['quantity'] += 1
+                else:
+                    basket[active_product_code] = {'id': product['id'], 'name': product['name'], 'unit': product['unit'], 'quantity': 1}
+                # 数量の入力欄は basket の値で作り直す
+                st.session_state.pop(f"basket_qty_{active_product_code}", None)
+                st.toast(f"「{product['name']}」をかごに入れました。")
+            else:
+                st.error(f"商品コード '{active_product_code}' が見つかりません。")
+            st.session_state.scanned_code = None
+            st.session_state.last_scanned_code = None
+            if "product_code" in st.query_params:
+                st.query_params.clear()
+            active_product_code = None
+
+        # 数量は basket に持つ。入力欄の値 (basket_qty_<コード>) は、欄を表示しない再実行
+        # (管理者ページの表示など) で Streamlit に消されるため、表示のたびに basket へ読み戻す
+        if basket:
+            st.subheader('かごの中身')
+            for code, item in list(basket.items()):
+                item_cols = st.columns([4, 2, 1])
+                item_cols[0].write(f"{item['name']}（{item['unit']}）")
+                item['quantity'] = item_cols[1].number_input('数量', min_value=1, max_value=1000, step=1, value=item['quantity'], key=f"basket_qty_{code}", label_visibility="collapsed")
+                if item_cols[2].button('削除', key=f"basket_remove_{code}"):
+                    del basket[code]
+                    st.rerun()
+            if st.button(f"かごの{len(basket)}品目をまとめて使用登録", type="primary", use_container_width=True):
+                changes = [(item['id'], -item['quantity']) for item in basket.values()]
+                journal.record_usages(changes, name, '使用')
+                st.session_state.basket = {}
+                st.success("かごの品目の使用を記録しました。")
+                st.balloons()
+                st.rerun()
+            st.markdown("---")
+
         if active_product_code:
             if st.session_state.get('last_scanned_code') != active_product_code:
                 st.session_state.last_scanned_code = active_product_code
                 st.rerun()
 
             product = database.get_product_by_code(active_product_code)
+            if product:
+                # まだスプレッドシートに反映されていない使用記録も在庫数に含めて表示する
+                product = journal.with_pending([product])[0]
             if not product:
                 st.error(f"商品コード '{active_product_code}' が見つかりません。")
             else:
@@ -199,11 +425,13 @@ if st.session_state["authentication_status"]:
 
                 st.subheader(f"品目名: {product['name']}")
                 st.metric(label="現在の在庫数", value=f"{current_stock} {product['unit']}")
+                reorder_threshold = product.get(database.REORDER_THRESHOLD_HEADER)
+                if isinstance(reorder_threshold, int) and 0 < current_stock <= reorder_threshold:
+                    st.warning(f"在庫が少なくなっています（発注点: {reorder_threshold} {product['unit']}）。")
                 
                 if current_stock > 0:
                     if st.button(f"「{product['name']}」を1つ使用する", type="primary", use_container_width=True):
-                        database.update_stock(product['id'], -1)
-                        database.add_stock_history(product['id'], name, '使用', 1)
+                        journal.record_usage(product['id'], -1, name, '使用')
                         st.session_state.scanned_code = None
                         st.session_state.last_scanned_code = None
                         if "product_code" in st.query_params:
@@ -215,6 +443,20 @@ if st.session_state["authentication_status"]:
                     st.error(f"「{product['name']}」の在庫がありません。")
         else:
             st.info("上のカメラでQRコードをスキャンしてください。")
+            # カメラの作動中は読み取り結果を待ち、届いたら再実行して商品を表示する
+            if webrtc_ctx.state.playing:
+                # 読み取り待ちのループは再実行の処理時間に含めない
+                metrics.mark('使用登録')
+                metrics.finish_rerun()
+                scan_status = st.empty()
+                while webrtc_ctx.state.playing:
+                    scanned_code = qr_scanner.pop_code(timeout=0.5)
+                    if scanned_code:
+                        st.session_state.scanned_code = scanned_code
+                        st.rerun()
+                    # 画面を更新することで、停止ボタンなどによる再実行要求を受け付けられる
+                    scan_status.caption("QRコードを読み取り中...")
+                scan_status.empty()
 
 
 # --- ログイン前の処理 ---
@@ -264,3 +506,6 @@ else:
                     database.add_user(name_reg, email_reg, hashed_password)
                     st.session_state.just_registered = True
                     st.rerun()
+
+metrics.mark('画面の表示')
+metrics.finish_rerun()
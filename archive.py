@@ -0,0 +1,262 @@
+# ==============================================================================
+# archive.py
+# ==============================================================================
+# stock_history の先頭から続く古い行を、月ごと (または年ごと) のアーカイブ用ワークシート
+# (stock_history_2025-04 など) か、ローカルの CSV ファイルへ移す。
+# 移した行の代わりに商品ごとの繰越行を履歴シートの先頭に残すので、reconcile.py の検算結果は
+# 変わらない。起点 (スナップショット) のある商品は database.CARRY_FORWARD_CHANGE_TYPE
+# (quantity = アーカイブした時点の在庫数)、無い商品は database.CARRY_FORWARD_DELTA_CHANGE_TYPE
+# (quantity = 移した行の増減の合計) になる。get_history() は期間の一部がアーカイブ済みのときだけ
+# ここを読む。管理者ページからの自動実行はバックグラウンドのスレッドで行う。
+#
+#   python archive.py                     # 設定どおり (既定: 180日より前を月ごとにシートへ)
+#   python archive.py --days 365 --granularity year --destination local
+import argparse
+import csv
+import datetime
+import glob
+import logging
+import os
+import threading
+import time
+from gspread.utils import numericise_all
+import database
+import reconcile
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = 180             # これより古い行をアーカイブする
+ARCHIVE_GRANULARITY = "month"        # "month" または "year"
+ARCHIVE_DESTINATION = "sheet"        # "sheet" (同じスプレッドシート) または "local" (CSV)
+ARCHIVE_DIR = "history_archive"      # destination が local のときの保存先
+AUTO_ARCHIVE_MIN_ROWS = 5000         # 自動実行は履歴シートの行数がこれを超えたときだけ
+AUTO_ARCHIVE_INTERVAL = 24 * 60 * 60 # 秒。自動実行を確認する間隔
+CARRY_FORWARD_USER = 'システム'
+
+# --- アーカイブの読み取りキャッシュ ---
+_cache_lock = threading.Lock()
+_partition_cache = {"names": None}   # パーティション名 -> 読み込み元 ("sheet" / CSV のパス)
+_records_cache = {}                  # パーティション名 -> レコードのリスト
+_last_auto_check = {"time": 0.0}
+
+
+def _setting(key, default):
+    return database.get_setting(key, default)
+
+
+def partition_name(timestamp, granularity):
+    """行の時刻からパーティション名 (stock_history_YYYY-MM / stock_history_YYYY) を返します。"""
+    suffix = timestamp.strftime('%Y') if granularity == "year" else timestamp.strftime('%Y-%m')
+    return database.HISTORY_ARCHIVE_PREFIX + suffix
+
+
+def _partition_period(name):
+    """パーティション名から、その期間の (最初の日, 最後の日) を返します。"""
+    suffix = name[len(database.HISTORY_ARCHIVE_PREFIX):]
+    if len(suffix) == 4:
+        year = int(suffix)
+        return datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+    year, month = int(suffix[:4]), int(suffix[5:7])
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    return datetime.date(year, month, 1), next_month - datetime.timedelta(days=1)
+
+
+def _local_path(name):
+    return os.path.join(_setting("archive_dir", ARCHIVE_DIR), name + ".csv")
+
+
+def _read_local(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+
+def _write_local(name, headers, rows):
+    """CSV に行を追記し、書き込んだ後に読み直して rows がすべてあれば True を返します。"""
+    path = _local_path(name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    is_new = not os.path.exists(path)
+    # 途中で失敗したアーカイブをやり直した場合に、同じ行を二重に書かない
+    new_rows = rows if is_new else database.missing_archive_rows(rows, _read_local(path)[1:])
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(headers)
+        writer.writerows(new_rows)
+    return not database.missing_archive_rows(rows, _read_local(path)[1:])
+
+
+def clear_cache():
+    """アーカイブの一覧と、読み込んだ行のキャッシュを消します。"""
+    with _cache_lock:
+        _partition_cache["names"] = None
+        _records_cache.clear()
+
+
+def _partitions():
+    with _cache_lock:
+        if _partition_cache["names"] is None:
+            names = {}
+            pattern = os.path.join(_setting("archive_dir", ARCHIVE_DIR), database.HISTORY_ARCHIVE_PREFIX + "*.csv")
+            for path in glob.glob(pattern):
+                names[os.path.splitext(os.path.basename(path))[0]] = path
+            for title in database.list_history_archives():
+                names[title] = "sheet"
+            _partition_cache["names"] = names
+        return dict(_partition_cache["names"])
+
+
+def _read_partition(name, source):
+    with _cache_lock:
+        if name in _records_cache:
+            return _records_cache[name]
+    if source == "sheet":
+        values = database.read_history_archive(name)
+    else:
+        values = _read_local(source)
+    records = []
+    if values:
+        headers = values[0]
+        for row in values[1:]:
+            row = numericise_all(list(row) + [''] * (len(headers) - len(row)))
+            records.append(dict(zip(headers, row)))
+    with _cache_lock:
+        _records_cache[name] = records
+    return records
+
+
+def partitions_for(start_date=None, end_date=None):
+    """期間 [start_date, end_date] と重なるアーカイブを、古い順に (名前, 読み込み元) で返します。
+
+    読み込み元は "sheet" (同名のワークシート) か、ローカルの CSV ファイルのパスです。
+    """
+    partitions = []
+    for name, source in sorted(_partitions().items()):
+        try:
+            first_day, last_day = _partition_period(name)
+        except ValueError:
+            continue
+        if (start_date and last_day < start_date) or (end_date and end_date < first_day):
+            continue
+        partitions.append((name, source))
+    return partitions
+
+
+def read_archived_records(start_date=None, end_date=None):
+    """期間 [start_date, end_date] と重なるアーカイブの行を、古い順のレコードで返します。"""
+    records = []
+    for name, source in partitions_for(start_date, end_date):
+        records.extend(_read_partition(name, source))
+    return records
+
+
+def archive_history(older_than_days=None, granularity=None, destination=None):
+    """older_than_days 日より前の履歴をアーカイブへ移し、移した行数を返します。
+
+    移すのは履歴シートの先頭から続く古い行だけです。アーカイブへの書き込みを読み直して確かめてから
+    履歴シートのその部分を繰越行に置き換えるので、途中で失敗しても履歴シートの行は失われず、
+    やり直してもアーカイブに同じ行は重複しません。
+    """
+    if database.STORAGE_BACKEND == "sqlite":
+        return 0
+    older_than_days = int(older_than_days or _setting("archive_after_days", ARCHIVE_AFTER_DAYS))
+    granularity = granularity or _setting("archive_granularity", ARCHIVE_GRANULARITY)
+    destination = destination or _setting("archive_destination", ARCHIVE_DESTINATION)
+    # 期間の境目は日単位 (その日の 0 時) にそろえ、繰越行の時刻にもこれを使う
+    cutoff = database._parse_timestamp(database._now_jst()).date() - datetime.timedelta(days=older_than_days)
+
+    with database.history_write_lock():
+        values = database.read_history_values()
+        if len(values) < 2:
+            return 0
+        headers, rows = values[0], values[1:]
+        timestamp_col = headers.index('timestamp')
+        # 先頭から、境目より古い行 (と空行) が続く所までを移す。それより後ろの行は繰越行の後に
+        # そのまま残るので、順序の入れ替わった古い行が残っても再生の結果は変わらない
+        head_count, archived, partitions = 0, [], {}
+        for row in rows:
+            if any(row):
+                timestamp = database._parse_timestamp(row[timestamp_col]) if timestamp_col < len(row) else None
+                if timestamp is None or timestamp.date() >= cutoff:
+                    break
+                archived.append(row)
+                partitions.setdefault(partition_name(timestamp, granularity), []).append(row)
+            head_count += 1
+        if not archived:
+            return 0
+
+        for name, partition_rows in sorted(partitions.items()):
+            if destination == "local":
+                written = _write_local(name, headers, partition_rows)
+            else:
+                written = database.append_history_archive(name, headers, partition_rows)
+            # 書き込めたことを確かめられない行は、履歴シートから消さない
+            if not written:
+                logger.warning("アーカイブ %s に移した行を確認できなかったため、アーカイブを中断しました。", name)
+                return 0
+
+        # 移した行 (前回の繰越行を含む) を再生し、その時点の在庫数か増減の合計を繰越行として残す
+        records = [dict(zip(headers, row)) for row in archived]
+        expected, has_snapshot = reconcile.replay(records)
+        timestamp = f"{cutoff:%Y-%m-%d} 00:00:00"
+        carry_rows = []
+        for product_id, quantity in sorted(expected.items()):
+            if product_id in has_snapshot:
+                change_type = database.CARRY_FORWARD_CHANGE_TYPE
+            elif quantity:
+                change_type = database.CARRY_FORWARD_DELTA_CHANGE_TYPE
+            else:
+                continue
+            row = database.new_history_row(product_id, CARRY_FORWARD_USER, change_type, int(quantity))
+            row[5] = timestamp
+            carry_rows.append(row)
+        # 商品の行が無くても、アーカイブ済みの境目が分かるように目印の繰越行を1つ置く
+        if not carry_rows:
+            row = database.new_history_row('', CARRY_FORWARD_USER, database.CARRY_FORWARD_CHANGE_TYPE, 0)
+            row[5] = timestamp
+            carry_rows.append(row)
+        if not database.replace_history_head(rows[:head_count], carry_rows):
+            logger.warning("履歴シートの先頭が読み込み後に変わったため、アーカイブを中断しました。")
+            return 0
+    clear_cache()
+    return len(archived)
+
+
+def _auto_archive():
+    try:
+        if len(database.get_history_records()) <= int(_setting("archive_min_rows", AUTO_ARCHIVE_MIN_ROWS)):
+            return
+        count = archive_history()
+        if count:
+            logger.info("古い使用履歴 %d 行をアーカイブしました。", count)
+    except Exception:
+        logger.exception("使用履歴の自動アーカイブに失敗しました。")
+
+
+def maybe_archive():
+    """履歴シートが大きくなっていれば、バックグラウンドで archive_history() を実行します。
+
+    確認は1日に1回までで、呼び出し元 (管理者ページの表示) は待たせません。確認を始めたら True を返します。
+    """
+    now = time.monotonic()
+    with _cache_lock:
+        if _last_auto_check["time"] and now - _last_auto_check["time"] < AUTO_ARCHIVE_INTERVAL:
+            return False
+        _last_auto_check["time"] = now
+    if database.STORAGE_BACKEND == "sqlite":
+        return False
+    threading.Thread(target=_auto_archive, name="history-archive", daemon=True).start()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="古い在庫履歴をアーカイブへ移します")
+    parser.add_argument('--days', type=int, help=f"これより古い行を移す (既定: {ARCHIVE_AFTER_DAYS})")
+    parser.add_argument('--granularity', choices=["month", "year"], help="アーカイブの単位")
+    parser.add_argument('--destination', choices=["sheet", "local"], help="移し先")
+    args = parser.parse_args()
+    count = archive_history(args.days, args.granularity, args.destination)
+    print(f"{count} 行をアーカイブしました。")
+
+
+if __name__ == '__main__':
+    main()
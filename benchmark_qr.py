@@ -0,0 +1,105 @@
+# QR読み取り処理のベンチマーク
+# 録画したフレーム (動画ファイル、または画像を入れたフォルダ) を使い、
+# 旧来の処理 (毎フレーム検出器を作って全体を読み取る) と qr_scanner.QrScanner を比べます。
+#
+#   python benchmark_qr.py recorded.mp4
+#   python benchmark_qr.py frames/ --sample-every 3 --max-side 480
+#   python benchmark_qr.py --synthetic 300     # 録画が無い場合は QR 入りのフレームを合成
+import argparse
+import glob
+import os
+import time
+import cv2
+import numpy as np
+import qrcode
+from qr_scanner import QrScanner, guide_box, parse_product_code
+
+
+def load_frames(path, limit):
+    """動画ファイルまたは画像フォルダからフレーム (BGR) を読み込みます。"""
+    frames = []
+    if os.path.isdir(path):
+        for file in sorted(glob.glob(os.path.join(path, '*'))):
+            img = cv2.imread(file)
+            if img is not None:
+                frames.append(img)
+            if len(frames) >= limit:
+                break
+    else:
+        capture = cv2.VideoCapture(path)
+        while len(frames) < limit:
+            ok, img = capture.read()
+            if not ok:
+                break
+            frames.append(img)
+        capture.release()
+    return frames
+
+
+def synthetic_frames(count, width=1280, height=720):
+    """ガイド枠の中に QR コードが写っている、ノイズ入りのフレームを作ります。"""
+    qr = np.array(qrcode.make("https://ouyasudalab-stock.streamlit.app?product_code=sani").convert('RGB'))[:, :, ::-1]
+    x, y, box_size = guide_box(width, height)
+    side = box_size * 3 // 4
+    qr = cv2.resize(qr, (side, side), interpolation=cv2.INTER_NEAREST)
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(count):
+        img = rng.integers(0, 80, size=(height, width, 3), dtype=np.uint8)
+        offset = (i % 10) * 2
+        top, left = y + (box_size - side) // 2 + offset, x + (box_size - side) // 2
+        img[top:top + side, left:left + side] = qr
+        frames.append(img)
+    return frames
+
+
+def naive_process(img):
+    """変更前の app.py と同じ処理。"""
+    height, width, _ = img.shape
+    x, y, box_size = guide_box(width, height)
+    cv2.rectangle(img, (x, y), (x + box_size, y + box_size), (0, 255, 0), 2)
+    data, _, _ = cv2.QRCodeDetector().detectAndDecode(img)
+    return parse_product_code(data) if data else None
+
+
+def run(name, process, frames):
+    decoded = 0
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for img in frames:
+        if process(img.copy()):
+            decoded += 1
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    print(f"{name:<10} {len(frames) / wall:8.1f} fps  CPU {cpu / len(frames) * 1000:7.2f} ms/frame"
+          f"  CPU使用率 {cpu / wall * 100:5.0f}%  読み取り {decoded}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QR読み取り処理のベンチマーク")
+    parser.add_argument('source', nargs='?', help="録画した動画ファイル、または画像フォルダ")
+    parser.add_argument('--synthetic', type=int, default=0, help="合成フレームの枚数 (source が無いとき)")
+    parser.add_argument('--limit', type=int, default=600, help="読み込むフレーム数の上限")
+    parser.add_argument('--sample-every', type=int, default=3)
+    parser.add_argument('--max-side', type=int, default=480)
+    args = parser.parse_args()
+
+    if args.source:
+        frames = load_frames(args.source, args.limit)
+    else:
+        frames = synthetic_frames(args.synthetic or 300)
+    if not frames:
+        parser.error("フレームを読み込めませんでした。")
+    print(f"{len(frames)} フレーム ({frames[0].shape[1]}x{frames[0].shape[0]})")
+
+    run("変更前", naive_process, frames)
+
+    scanner = QrScanner(sample_every=args.sample_every, max_side=args.max_side, debounce_seconds=0)
+
+    def scanner_process(img):
+        scanner.process_image(img)
+        return scanner.pop_code()
+
+    run("QrScanner", scanner_process, frames)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# Sheets API 呼び出し回数のベンチマーク
+# fake_gspread.FakeSpreadsheet (メモリ上のスプレッドシート) に商品・ユーザー・履歴を用意し、
+# 利用者の操作ごとに API 呼び出しの回数と所要時間を測ります。実際のシートには触れません。
+#
+#   python benchmark_sheets.py
+#   python benchmark_sheets.py --sizes 50x1000,2000x50000 --latency 0.05
+#   python benchmark_sheets.py --save baseline.json        # 呼び出し回数を記録
+#   python benchmark_sheets.py --compare baseline.json     # 記録より増えていたら終了コード 1
+#   python benchmark_sheets.py --check-scaling             # 履歴 100 行と 100,000 行で回数が同じか
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("PYSTOCK_STORAGE_BACKEND", "sheets")
+
+import bcrypt
+import analytics
+import database
+import journal
+import seed
+from fake_gspread import FakeSpreadsheet
+
+DEFAULT_SIZES = "50x1000,500x10000,2000x50000"
+USER_COUNT = 50
+HISTORY_DAYS = 180
+# --check-scaling で比べる (商品数, 履歴行数)
+SCALING_SIZES = ((50, 100), (50, 100_000))
+
+
+def build_spreadsheet(product_count, history_count, **fake_options):
+    """商品 product_count 件、履歴 history_count 行のスプレッドシートを作ります。"""
+    spreadsheet = FakeSpreadsheet(**fake_options)
+    created_at = "2025-01-01 00:00:00"
+    spreadsheet.load("products", [database.PRODUCT_HEADERS] + [
+        [i, f"P{i:05d}", f"備品{i}", "箱", 20 + i % 30, created_at, 10 if i % 5 == 0 else ""]
+        for i in range(1, product_count + 1)
+    ])
+    # ログインの照合はここでは測らないので、ハッシュは1つを使い回す
+    hashed = bcrypt.hashpw(b"password", bcrypt.gensalt(rounds=4)).decode()
+    spreadsheet.load("users", [["name", "email", "hashed_password"]] + [
+        [f"利用者{i}", f"user{i}", hashed] for i in range(USER_COUNT)
+    ])
+    start = datetime.datetime(2026, 1, 1)
+    step = datetime.timedelta(days=HISTORY_DAYS) / max(history_count, 1)
+    history = [["id", "product_id", "user_name", "change_type", "quantity", "timestamp", "misc_item_name"]]
+    for i in range(history_count):
+        change_type = "入荷" if i % 10 == 0 else "使用"
+        history.append([i + 1, i % product_count + 1, f"利用者{i % USER_COUNT}", change_type,
+                        5 if change_type == "入荷" else 1, (start + step * i).strftime("%Y-%m-%d %H:%M:%S"), ""])
+    spreadsheet.load("stock_history", history)
+    return spreadsheet
+
+
+class ForegroundJournal(journal.Journal):
+    """反映のワーカーを起動しないジャーナル。反映はベンチマークから flush() で直接行います。"""
+
+    def start(self):
+        pass
+
+
+def journal_use(events, product_id, interrupted=False):
+    """使用を1件ジャーナルに記録して反映します (アプリの使用登録と同じ経路)。
+
+    interrupted=True なら、前回の反映が応答なしで終わった状態にしてから反映するので、
+    履歴を読んで二重登録を防ぐ確認も含めて測ります。
+    """
+    events.record(product_id, -1, "利用者1", "使用")
+    if interrupted:
+        events._update_events("UPDATE events SET attempts = attempts + 1 WHERE flushed = 0 AND history_id = ?",
+                              [e['history_id'] for e in events._pending_events()])
+    events.flush()
+
+
+def admin_render():
+    """管理者ページのデータ読み込み (表示の前に行う処理)。"""
+    products = database.load_admin_page_data()["products"]
+    database.get_history(limit=100, refresh=False)
+    database.get_low_stock_products()
+    analytics.usage_report(products, refresh=False)
+
+
+def scenarios(product_count, events):
+    """(操作名, 処理) の一覧。この順に、同じスプレッドシートの上で実行します。
+
+    events は使用の記録に使うジャーナル (ForegroundJournal)。
+    """
+    code = f"P{product_count // 2:05d}"
+    product_id = product_count // 2
+    return [
+        ("login (cold)", lambda: database.get_user("user7")),
+        ("login (warm)", lambda: database.get_user("user8")),
+        ("scan lookup (cold)", lambda: database.get_product_by_code(code)),
+        ("scan lookup (warm)", lambda: database.get_product_by_code(code)),
+        ("use one", lambda: database.adjust_stock(product_id, -1, "利用者1", "使用")),
+        ("use one (again)", lambda: database.adjust_stock(product_id, -1, "利用者1", "使用")),
+        ("use one (journal)", lambda: journal_use(events, product_id)),
+        ("use one (journal retry)", lambda: journal_use(events, product_id, interrupted=True)),
+        ("admin render (cold)", admin_render),
+        ("admin render (warm)", admin_render),
+        ("seed", lambda: database.add_products(seed.products_to_seed)),
+    ]
+
+
+def run_size(product_count, history_count, **fake_options):
+    spreadsheet = build_spreadsheet(product_count, history_count, **fake_options)
+    database.use_spreadsheet(spreadsheet)
+    journal_dir = tempfile.TemporaryDirectory()
+    events = ForegroundJournal(os.path.join(journal_dir.name, "journal.db"))
+    results = []
+    for name, action in scenarios(product_count, events):
+        if name == "admin render (cold)":
+            # 管理者ページは別のセッションで開かれることが多いので、履歴も読み込み直す
+            database.invalidate_product_cache()
+            database.invalidate_history_cache()
+        spreadsheet.reset_stats()
+        started = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started
+        results.append({
+            "size": f"{product_count}x{history_count}", "action": name,
+            "calls": spreadsheet.total_calls(), "failures": spreadsheet.failures,
+            "ops": dict(spreadsheet.calls), "ms": round(elapsed * 1000, 1),
+        })
+    journal_dir.cleanup()
+    return results
+
+
+def compare(results, baseline_path):
+    """記録と比べて呼び出し回数が増えた操作を返します。"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["size"], r["action"]): r["calls"] - r.get("failures", 0) for r in json.load(f)}
+    regressions = []
+    for r in results:
+        expected = baseline.get((r["size"], r["action"]))
+        if expected is not None and r["calls"] - r["failures"] > expected:
+            regressions.append(f"{r['size']} {r['action']}: {expected} -> {r['calls'] - r['failures']} 回")
+    return regressions
+
+
+def check_scaling(**fake_options):
+    """履歴が SCALING_SIZES の2通りのとき、各操作の API 呼び出し回数が同じかを確かめます。
+
+    回数の違った操作を返します (空なら、記録などの回数は履歴の行数によらず一定)。
+    """
+    small, large = (run_size(product_count, history_count, **fake_options)
+                    for product_count, history_count in SCALING_SIZES)
+    differences = []
+    for a, b in zip(small, large):
+        a_calls, b_calls = a["calls"] - a["failures"], b["calls"] - b["failures"]
+        if a_calls != b_calls:
+            differences.append(f"{a['action']}: {a['size']} で {a_calls} 回、{b['size']} で {b_calls} 回")
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sheets API 呼び出し回数のベンチマーク")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="商品数x履歴行数 をカンマ区切りで (既定: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0, help="1回の API 呼び出しにかける秒数")
+    parser.add_argument("--jitter", type=float, default=0.0, help="遅延のゆらぎ (秒)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="429 を起こす確率 (再試行の待ち時間も測る)")
+    parser.add_argument("--save", help="結果を JSON で保存する")
+    parser.add_argument("--compare", help="保存した結果と呼び出し回数を比べる")
+    parser.add_argument("--check-scaling", action="store_true",
+                        help="履歴の行数を変えても各操作の呼び出し回数が変わらないかを確かめる")
+    args = parser.parse_args()
+
+    if args.check_scaling:
+        differences = check_scaling(latency=args.latency, jitter=args.jitter, fail_rate=args.fail_rate)
+        if differences:
+            print("履歴の行数によって呼び出し回数が変わる操作:")
+            for line in differences:
+                print("  " + line)
+            sys.exit(1)
+        print("履歴の行数によらず、すべての操作の呼び出し回数は同じです。")
+        return
+
+    results = []
+    print(f"{'size':<12} {'action':<24} {'calls':>5} {'429':>4} {'ms':>9}  ops")
+    for size in args.sizes.split(","):
+        product_count, history_count = (int(v) for v in size.lower().split("x"))
+        for r in run_size(product_count, history_count,
+                          latency=args.latency, jitter=args.jitter, fail_rate=args.fail_rate):
+            ops = ", ".join(f"{op}={n}" for op, n in sorted(r["ops"].items()))
+            print(f"{r['size']:<12} {r['action']:<24} {r['calls']:>5} {r['failures']:>4} {r['ms']:>9.1f}  {ops}")
+            results.append(r)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare)
+        if regressions:
+            print("\n呼び出し回数が増えた操作:")
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print("\n呼び出し回数の増加はありません。")
+
+
+if __name__ == "__main__":
+    main()
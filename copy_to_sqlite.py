@@ -0,0 +1,30 @@
+# ==============================================================================
+# copy_to_sqlite.py
+# ==============================================================================
+# スプレッドシートの商品・ユーザー・在庫履歴を、SQLite バックエンド (sqlite_store.py) の
+# ファイルへ写す。storage_backend = "sqlite" に切り替える前に1回実行する。写し先は設定の
+# sqlite_path (既定: pystock.db) で、既に中身があるときは --replace を付けたときだけ置き換える。
+# アーカイブ済みの履歴 (archive.py) は写さない。
+#
+#   python copy_to_sqlite.py
+#   python copy_to_sqlite.py --replace
+import argparse
+import sys
+import database
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スプレッドシートの内容を SQLite ファイルへ写します")
+    parser.add_argument('--replace', action='store_true', help="SQLite ファイルに既にある内容を置き換える")
+    args = parser.parse_args()
+    path = database.get_setting("sqlite_path", "pystock.db")
+    if database._sqlite_store().get_all_products() and not args.replace:
+        print(f"{path} には既に商品があります。置き換える場合は --replace を付けてください。", file=sys.stderr)
+        sys.exit(1)
+    counts = database.copy_sheets_to_sqlite()
+    print(f"{path} へ商品 {counts['products']} 件、ユーザー {counts['users']} 件、"
+          f"履歴 {counts['history']} 行を写しました。")
+
+
+if __name__ == '__main__':
+    main()
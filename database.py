@@ -4,10 +4,22 @@
 import gspread
 from google.oauth2.service_account import Credentials
 import streamlit as st
+from gspread.utils import numericise_all, rowcol_to_a1
 from datetime import datetime
 import os
 import json
+import collections
+import functools
+import logging
+import threading
+import time
+import random
+import sys
+import requests
 import pytz
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # --- Googleスプレッドシートに接続 ---
 def get_gspread_client():
@@ -30,105 +42,966 @@ def get_gspread_client():
     return client
 
 SPREADSHEET_ID = "1kFw-RGElLZOLtMmijTRExBAKcSJ2yiqLR0BuqAF8G1c"
-try:
-    gspread_client = get_gspread_client()
-    spreadsheet = gspread_client.open_by_key(SPREADSHEET_ID)
-    products_sheet = spreadsheet.worksheet("products")
-    history_sheet = spreadsheet.worksheet("stock_history")
-    users_sheet = spreadsheet.worksheet("users")
-except Exception as e:
-    st.error(f"スプレッドシートへの接続に失敗しました: {e}")
-    st.stop()
+
+# --- API 呼び出しの再試行 ---
+# 読み取りは 429 (クォータ超過) と 5xx、通信エラーを指数バックオフ (+ゆらぎ) で再試行する。
+# 追記のように繰り返すと結果が変わる書き込みは、サーバーが受け付けなかったと分かる 429 だけを
+# 再試行する。5xx・通信エラーは書き込まれたかどうか分からないため、履歴行を含む書き込みは
+# _call_with_history() で履歴 ID がシートにあるかを確かめてから送り直す。
+API_MAX_RETRIES = 5
+API_BACKOFF_BASE = 1.0  # 秒
+API_BACKOFF_MAX = 32.0  # 秒
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+WRITE_RETRYABLE_STATUS = {429}
+
+def _is_retryable(e, write=False):
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code in (WRITE_RETRYABLE_STATUS if write else RETRYABLE_STATUS)
+    return not write and isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def _outcome_unknown(e):
+    """書き込みが反映されたかどうか分からないエラー (5xx・通信エラー) なら True を返します。"""
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code in RETRYABLE_STATUS - WRITE_RETRYABLE_STATUS
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def _backoff(attempt):
+    time.sleep(min(API_BACKOFF_BASE * 2 ** attempt, API_BACKOFF_MAX) + random.uniform(0, 1))
+
+def _invoke(func, args, kwargs, caller, write):
+    for attempt in range(API_MAX_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            metrics.record_call(func, caller, time.perf_counter() - started, error=e)
+            if attempt == API_MAX_RETRIES or not _is_retryable(e, write):
+                raise
+            _backoff(attempt)
+            continue
+        metrics.record_call(func, caller, time.perf_counter() - started, result=result)
+        return result
+
+def _call(func, *args, **kwargs):
+    """Sheets API を呼び出します。一時的なエラーはバックオフしながら再試行します。
+
+    読み取りと、同じ内容で上書きするだけの書き込み (updateCells など) に使います。
+    呼び出しは1回ごとに metrics.py に記録します (呼び出し元は _call を呼んだ関数)。
+    """
+    return _invoke(func, args, kwargs, sys._getframe(1).f_code.co_name, write=False)
+
+def _call_write(func, *args, **kwargs):
+    """繰り返すと結果が変わる書き込み (追記・findReplace) を呼び出します。再試行は 429 のときだけです。"""
+    return _invoke(func, args, kwargs, sys._getframe(1).f_code.co_name, write=True)
+
+def _call_with_history(func, history_rows, *args, **kwargs):
+    """履歴行 history_rows を追記する書き込みを呼び出します。
+
+    5xx・通信エラーで結果が分からないときは、履歴 ID が既にシートにあるかを確かめ、無いときだけ
+    送り直します (batchUpdate は全体が反映されるか、何も反映されないかのどちらか)。既に書き込まれて
+    いた場合は None を返します。
+    """
+    caller = sys._getframe(1).f_code.co_name
+    for attempt in range(API_MAX_RETRIES + 1):
+        try:
+            return _invoke(func, args, kwargs, caller, write=True)
+        except Exception as e:
+            if attempt == API_MAX_RETRIES or not _outcome_unknown(e):
+                raise
+            if _history_written(history_rows):
+                logger.warning("応答の無かった書き込みが反映されていたため、送り直しません (%s)。", caller)
+                return None
+            _backoff(attempt)
+
+# --- 接続 (初回利用時に作成し、プロセス内の全セッション・再実行で使い回す) ---
+@st.cache_resource(show_spinner=False)
+def _connect():
+    client = get_gspread_client()
+    return _call(client.open_by_key, SPREADSHEET_ID)
+
+@st.cache_resource(show_spinner=False)
+def _open_worksheet(title):
+    return _call(_connect().worksheet, title)
+
+# --- 接続先の差し替え (fake_gspread.py を使うベンチマークなど) ---
+_spreadsheet_override = {"spreadsheet": None, "worksheets": {}}
+
+def use_spreadsheet(spreadsheet):
+    """以降の読み書きを spreadsheet (gspread の Spreadsheet と同じ操作を持つもの) へ向けます。
+
+    None を渡すと本来のスプレッドシートに戻します。どちらの場合もキャッシュは読み直させます。
+    """
+    _spreadsheet_override.update(spreadsheet=spreadsheet, worksheets={})
+    invalidate_product_cache()
+    invalidate_history_cache()
+    invalidate_user_cache()
+
+def _spreadsheet():
+    if _spreadsheet_override["spreadsheet"] is not None:
+        return _spreadsheet_override["spreadsheet"]
+    try:
+        return _connect()
+    except Exception as e:
+        st.error(f"スプレッドシートへの接続に失敗しました: {e}")
+        st.stop()
+
+def _worksheet(title):
+    override = _spreadsheet_override["spreadsheet"]
+    if override is not None:
+        worksheets = _spreadsheet_override["worksheets"]
+        if title not in worksheets:
+            worksheets[title] = _call(override.worksheet, title)
+        return worksheets[title]
+    try:
+        return _open_worksheet(title)
+    except Exception as e:
+        st.error(f"スプレッドシートへの接続に失敗しました: {e}")
+        st.stop()
+
+def _products_sheet():
+    return _worksheet("products")
+
+def _history_sheet():
+    return _worksheet("stock_history")
+
+def _users_sheet():
+    return _worksheet("users")
+
+# --- ストレージバックエンドの選択 ---
+# storage_backend は環境変数 PYSTOCK_STORAGE_BACKEND、st.secrets の順に探す。
+#   "sheets" (既定): Google スプレッドシートを直接読み書きする
+#   "sqlite": sqlite_path のローカル SQLite ファイルを使う (sqlite_store.py)。切り替える前に
+#             python copy_to_sqlite.py でスプレッドシートの内容を写しておく
+def get_setting(key, default=None):
+    env_value = os.environ.get(f"PYSTOCK_{key.upper()}")
+    if env_value is not None:
+        return env_value
+    try:
+        return st.secrets.get(key, default)
+    except FileNotFoundError:
+        return default
+
+STORAGE_BACKEND = get_setting("storage_backend", "sheets")
+
+@st.cache_resource(show_spinner=False)
+def _sqlite_store():
+    import sqlite_store
+    return sqlite_store.SqliteStore(get_setting("sqlite_path", "pystock.db"))
+
+def _local_store():
+    return _sqlite_store() if STORAGE_BACKEND == "sqlite" else None
+
+def _backend_method(func):
+    """SQLite バックエンドが選ばれていれば、同名のメソッドに処理を任せます。"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        store = _local_store()
+        if store is not None:
+            return getattr(store, func.__name__)(*args, **kwargs)
+        return func(*args, **kwargs)
+    return wrapper
+
+def copy_sheets_to_sqlite():
+    """スプレッドシートの内容で SQLite バックエンドを初期化します (既存の内容は置き換え)。
+
+    写した行数を {"products": 件数, "users": 件数, "history": 件数} で返します。
+    """
+    with _product_cache_lock:
+        _load_product_cache()
+        products = list(_product_cache["records"])
+    users = _call(_users_sheet().get_all_records, numericise_ignore=['all'])
+    values = _call(_history_sheet().get_all_values, **EXACT_READ_OPTIONS)
+    history = _history_records(values[1:], values[0]) if values else []
+    _sqlite_store().replace_all(products, users, history)
+    return {"products": len(products), "users": len(users), "history": len(history)}
+
+# --- ユーザー一覧のキャッシュ ---
+# users シートを1回で読み込み、ユーザーネーム (2列目) からユーザー情報を引ける辞書を
+# プロセス全体で共有する。add_user で書き込んだ分はその場で反映し、TTL ごとに読み直す。
+USER_CACHE_TTL = 300  # 秒
+USER_NAME_COL = 2
+
+_user_cache_lock = threading.Lock()
+_user_cache = {
+    "loaded_at": 0.0,
+    "headers": [],
+    "by_name": {},  # ユーザーネーム -> ユーザー情報 (dict)
+}
+
+def _get_user_cache():
+    with _user_cache_lock:
+        if time.time() - _user_cache["loaded_at"] > USER_CACHE_TTL:
+            values = _call(_users_sheet().get_all_values)
+            headers = values[0] if values else []
+            by_name = {}
+            for row in values[1:]:
+                if len(row) >= USER_NAME_COL and row[USER_NAME_COL - 1]:
+                    by_name.setdefault(row[USER_NAME_COL - 1], dict(zip(headers, _trim_row(row))))
+            _user_cache.update(loaded_at=time.time(), headers=headers, by_name=by_name)
+        return _user_cache
+
+def invalidate_user_cache():
+    """次回の参照時に users シートを読み直させます。"""
+    with _user_cache_lock:
+        _user_cache["loaded_at"] = 0.0
 
 # --- ユーザー管理用の関数 ---
+@_backend_method
 def get_user(email):
-    try:
-        cell = users_sheet.find(email, in_column=2)
-        if cell:
-            headers = users_sheet.row_values(1)
-            user_data = users_sheet.row_values(cell.row)
-            return dict(zip(headers, user_data))
-        return None
-    except gspread.exceptions.CellNotFound:
-        return None
+    user = _get_user_cache()["by_name"].get(str(email))
+    return dict(user) if user else None
 
+@_backend_method
 def add_user(name, email, hashed_password):
     new_row = [str(name), str(email), str(hashed_password)]
-    users_sheet.append_row(new_row, value_input_option='USER_ENTERED')
+    _call_write(_users_sheet().append_row, new_row, value_input_option='USER_ENTERED')
+    with _user_cache_lock:
+        if _user_cache["headers"]:
+            _user_cache["by_name"][str(email)] = dict(zip(_user_cache["headers"], new_row))
+
+# --- 商品カタログのキャッシュ ---
+# products シートを一度だけ読み込み、product_code / id から (行番号, レコード) を引ける辞書を
+# プロセス全体 (全セッション) で共有する。TTL が切れるか、このプロセスが products シートへ
+# 書き込んだときに読み直す。
+PRODUCT_CACHE_TTL = 300  # 秒
+CURRENT_STOCK_COL = 5
+
+_product_cache_lock = threading.Lock()
+_product_cache = {
+    "loaded_at": 0.0,
+    "headers": [],
+    "records": [],  # get_all_products() の戻り値 (シート上の順序)
+    "by_code": {},  # str(product_code) -> (行番号, レコード)
+    "by_id": {},    # str(id) -> (行番号, レコード)
+    "low_stock": {},  # str(id) -> レコード (在庫数が発注点以下の商品)
+}
+
+def _product_record(headers, row):
+    """products シートの1行をレコードにします。数値に直すのは PRODUCT_NUMERIC_HEADERS の列だけです。"""
+    row = row + [''] * (len(headers) - len(row))
+    return {
+        header: numericise_all([value])[0] if header in PRODUCT_NUMERIC_HEADERS else value
+        for header, value in zip(headers, row)
+    }
+
+def _load_product_cache(values=None):
+    """products シートを1回の API 呼び出しで読み込み、索引を作り直します。
+
+    values を渡した場合は、読み込み済みのシートの値から索引だけを作ります。
+    """
+    if values is None:
+        values = _call(_products_sheet().get_all_values)
+    headers = values[0] if values else []
+    records, by_code, by_id, low_stock = [], {}, {}, {}
+    for row_num, row in enumerate(values[1:], start=2):
+        record = _product_record(headers, row)
+        if not record.get('id'):
+            continue
+        records.append(record)
+        by_id[str(record['id'])] = (row_num, record)
+        if record.get('product_code') != '':
+            by_code[str(record['product_code'])] = (row_num, record)
+        if _is_low_stock(record):
+            low_stock[str(record['id'])] = record
+    _product_cache.update(
+        loaded_at=time.time(), headers=headers, records=records, by_code=by_code, by_id=by_id,
+        low_stock=low_stock,
+    )
+
+def _product_cache_expired():
+    return time.time() - _product_cache["loaded_at"] > PRODUCT_CACHE_TTL
+
+def _get_product_cache():
+    with _product_cache_lock:
+        if _product_cache_expired():
+            _load_product_cache()
+        return _product_cache
+
+def invalidate_product_cache():
+    """次回の参照時に products シートを読み直させます。"""
+    with _product_cache_lock:
+        _product_cache["loaded_at"] = 0.0
+
+def _set_cached_stock(product_id, new_stock):
+    with _product_cache_lock:
+        entry = _product_cache["by_id"].get(str(product_id))
+        if not entry:
+            return
+        entry[1]['current_stock'] = new_stock
+        became_low = _update_low_stock(entry[1])
+    if became_low:
+        _notify_low_stock(entry[1])
+
+# --- 発注点 (在庫が少ない商品の一覧) ---
+# products シートの reorder_threshold 列 (空欄なら対象外) を発注点とし、在庫数が発注点以下の
+# 商品を商品キャッシュの "low_stock" に持つ。一覧はキャッシュの読み込み時に作り、以降は
+# 在庫数を書き込むたびにその商品だけを入れ替えるので、参照に API 呼び出しは要らない。
+REORDER_THRESHOLD_HEADER = 'reorder_threshold'
+
+def _is_low_stock(record):
+    threshold, stock = record.get(REORDER_THRESHOLD_HEADER, ''), record.get('current_stock', '')
+    if not isinstance(threshold, (int, float)) or isinstance(threshold, bool):
+        return False
+    return isinstance(stock, (int, float)) and stock <= threshold
+
+def _update_low_stock(record):
+    """キャッシュの一覧を record に合わせて更新し、新たに発注点以下になったら True を返します。"""
+    key, low_stock = str(record['id']), _product_cache["low_stock"]
+    if not _is_low_stock(record):
+        low_stock.pop(key, None)
+        return False
+    became_low = key not in low_stock
+    low_stock[key] = record
+    return became_low
+
+def _notify_low_stock(record):
+    logger.warning(
+        "在庫が発注点以下になりました: %s (%s) 在庫 %s / 発注点 %s",
+        record.get('name'), record.get('product_code'), record.get('current_stock'), record.get(REORDER_THRESHOLD_HEADER),
+    )
+    digest_path = get_setting("low_stock_digest_path", "")
+    if digest_path:
+        try:
+            write_low_stock_digest(digest_path)
+        except OSError:
+            logger.exception("在庫不足の一覧を %s に書き込めませんでした。", digest_path)
+
+@_backend_method
+def get_low_stock_products():
+    """在庫数が発注点以下の商品を、発注点との差が大きい順に返します (API 呼び出しなし)。"""
+    with _product_cache_lock:
+        if _product_cache_expired():
+            _load_product_cache()
+        records = [dict(record) for record in _product_cache["low_stock"].values()]
+    return sorted(records, key=lambda r: r['current_stock'] - r[REORDER_THRESHOLD_HEADER])
+
+def write_low_stock_digest(path):
+    """在庫が少ない商品の一覧をテキストファイルに書き出します。"""
+    lines = [f"在庫が発注点以下の品目 ({_now_jst()} 時点)"]
+    for product in get_low_stock_products():
+        lines.append(f"- {product['name']} ({product['product_code']}): 在庫 {product['current_stock']}"
+                     f" {product.get('unit', '')} / 発注点 {product[REORDER_THRESHOLD_HEADER]}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+@_backend_method
+def set_reorder_thresholds(thresholds):
+    """発注点 {product_id: 発注点 (None なら空欄)} をまとめて書き込みます (1回の batchUpdate)。
+
+    products シートに reorder_threshold 列が無ければ、見出しを追加します。
+    """
+    cache = _get_product_cache()
+    headers = cache["headers"] or PRODUCT_HEADERS
+    sheet_id = _products_sheet().id
+    threshold_requests = []
+    if REORDER_THRESHOLD_HEADER in headers:
+        col = headers.index(REORDER_THRESHOLD_HEADER)
+    else:
+        col = len(headers)
+        threshold_requests.append({"updateCells": {
+            "range": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": col, "endColumnIndex": col + 1},
+            "rows": [{"values": [_to_cell_data(REORDER_THRESHOLD_HEADER)]}], "fields": "userEnteredValue",
+        }})
+    written = []
+    for product_id, threshold in thresholds.items():
+        row = _find_product_row(product_id)
+        if row is None:
+            continue
+        value = '' if threshold is None or threshold == '' else int(threshold)
+        threshold_requests.append({"updateCells": {
+            "range": {"sheetId": sheet_id, "startRowIndex": row - 1, "endRowIndex": row, "startColumnIndex": col, "endColumnIndex": col + 1},
+            "rows": [{"values": [_to_cell_data(value)]}], "fields": "userEnteredValue",
+        }})
+        written.append((product_id, value))
+    if not written:
+        return
+    _call(_spreadsheet().batch_update, {"requests": threshold_requests})
+    became_low = []
+    with _product_cache_lock:
+        if REORDER_THRESHOLD_HEADER not in _product_cache["headers"]:
+            _product_cache["headers"] = list(headers) + [REORDER_THRESHOLD_HEADER]
+        for product_id, value in written:
+            entry = _product_cache["by_id"].get(str(product_id))
+            if entry:
+                entry[1][REORDER_THRESHOLD_HEADER] = value
+                if _update_low_stock(entry[1]):
+                    became_low.append(entry[1])
+    for record in became_low:
+        _notify_low_stock(record)
 
 # --- 在庫管理用の関数 ---
 def init_db():
     pass
 
+@_backend_method
 def get_all_products():
-    records = products_sheet.get_all_records()
-    return [row for row in records if row.get('id')]
+    return list(_get_product_cache()["records"])
 
+@_backend_method
 def get_product_by_code(product_code):
+    entry = _get_product_cache()["by_code"].get(str(product_code))
+    return dict(entry[1]) if entry else None
+
+def _find_product_row(product_id):
+    """キャッシュから商品の行番号を返します。見つからなければ None。"""
+    entry = _get_product_cache()["by_id"].get(str(product_id))
+    return entry[0] if entry else None
+
+# --- 商品の一括登録 ---
+PRODUCT_HEADERS = ['id', 'product_code', 'name', 'unit', 'current_stock', 'created_at', REORDER_THRESHOLD_HEADER]
+# 数値として読む列。product_code や name は "0012" のような値を崩さないよう、シートの文字列のまま持つ
+PRODUCT_NUMERIC_HEADERS = ('id', 'current_stock', REORDER_THRESHOLD_HEADER)
+
+def _split_new_products(products, existing_codes):
+    """登録する商品と、既存・重複のためスキップする商品に分けます。"""
+    new_products, skipped, seen = [], [], set(existing_codes)
+    for product in products:
+        code = str(product.get("code") or product.get("product_code") or '').strip()
+        if not code or code in seen:
+            skipped.append(product)
+            continue
+        seen.add(code)
+        new_products.append(dict(product, code=code))
+    return new_products, skipped
+
+@_backend_method
+def add_products(products, dry_run=False):
+    """商品をまとめて登録します。
+
+    products は {"code", "name", "unit"} (任意で "current_stock", "reorder_threshold") の辞書のリスト。既存の
+    product_code と入力内の重複はスキップし、新しい商品だけを1回の append_rows で書き込みます。
+    dry_run=True なら書き込まずに結果だけを返します。
+    戻り値は {"inserted": [...], "skipped": [...]} (それぞれ入力の辞書、inserted には id 付き)。
+    """
+    invalidate_product_cache()
+    cache = _get_product_cache()
+    new_products, skipped = _split_new_products(products, cache["by_code"].keys())
+    next_id = max((int(r['id']) for r in cache["records"] if isinstance(r['id'], int)), default=0) + 1
+    headers = cache["headers"] or PRODUCT_HEADERS
+    created_at = _now_jst()
+    rows, inserted = [], []
+    for product_id, product in enumerate(new_products, start=next_id):
+        record = {
+            'id': product_id, 'product_code': product['code'], 'name': product.get('name', ''),
+            'unit': product.get('unit', ''), 'current_stock': product.get('current_stock', 0),
+            'created_at': created_at, REORDER_THRESHOLD_HEADER: product.get(REORDER_THRESHOLD_HEADER, ''),
+        }
+        # RAW で書き込むので、数値の列は CSV から読んだ文字列でも数値に直しておく
+        rows.append([numericise_all([record.get(h, '')])[0] if h in PRODUCT_NUMERIC_HEADERS else record.get(h, '')
+                     for h in headers])
+        inserted.append(dict(product, id=product_id))
+    if rows and not dry_run:
+        # USER_ENTERED だと "0012" のような商品コードが数値 12 になるため、RAW で書き込む
+        _call_write(_products_sheet().append_rows, rows, value_input_option='RAW')
+        invalidate_product_cache()
+    return {"inserted": inserted, "skipped": skipped}
+
+# --- 在庫数の更新 (1回の batchUpdate で在庫と履歴をまとめて書き込む) ---
+# Sheets には条件付き書き込みが無いため、在庫セルの更新は「キャッシュ上の在庫数と完全一致した
+# ときだけ置換する」findReplace で行い、置換件数が 0 なら他の誰かが先に書き換えたとみなして
+# 読み直してから再試行する。履歴行は実際に起きた出来事なので、在庫の競合とは関係なく同じ
+# リクエスト内で追記する。同一プロセス内の書き込みはロックで直列化する。
+STOCK_CAS_RETRIES = 3
+
+_stock_write_lock = threading.Lock()
+
+def _to_cell_data(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+def _stock_cell_range(row):
+    return {
+        "sheetId": _products_sheet().id,
+        "startRowIndex": row - 1, "endRowIndex": row,
+        "startColumnIndex": CURRENT_STOCK_COL - 1, "endColumnIndex": CURRENT_STOCK_COL,
+    }
+
+def _stock_write_request(row, expected, new_stock):
+    """expected が整数なら比較付きの置換、None なら無条件の上書きリクエストを返します。"""
+    if expected is not None:
+        return {"findReplace": {
+            "find": str(expected), "replacement": str(new_stock),
+            "matchEntireCell": True, "range": _stock_cell_range(row),
+        }}
+    return {"updateCells": {
+        "range": _stock_cell_range(row), "rows": [{"values": [_to_cell_data(new_stock)]}],
+        "fields": "userEnteredValue",
+    }}
+
+def _history_sheet_row(row):
+    """履歴の1行を、シートに書き込む値のリストにします。
+
+    ID は 16 桁あり、数値で書くと表示形式で丸められて (1.79235E+15) 読み出した値と一致しなくなるので、
+    文字列のまま書きます。
+    """
+    return [str(row[0])] + list(row[1:])
+
+def _history_append_request(history_rows):
+    return {"appendCells": {
+        "sheetId": _history_sheet().id,
+        "rows": [{"values": [_to_cell_data(v) for v in _history_sheet_row(row)]} for row in history_rows],
+        "fields": "userEnteredValue",
+    }}
+
+def _reload_stock_rows(product_ids):
+    """競合した商品の行を1回の API 呼び出しで読み直し、キャッシュの在庫数を更新します。"""
+    located = [(pid, row) for pid, row in ((pid, _find_product_row(pid)) for pid in product_ids) if row]
+    ranges = [f"A{row}:{rowcol_to_a1(row, CURRENT_STOCK_COL)}" for _, row in located]
+    fetched = _call(_products_sheet().batch_get, ranges) if ranges else []
+    stale = False
+    for (pid, row), values in zip(located, fetched):
+        row_values = values[0] if values else []
+        if not row_values or str(row_values[0]) != str(pid):
+            stale = True
+            continue
+        row_values = row_values + [''] * (CURRENT_STOCK_COL - len(row_values))
+        _set_cached_stock(pid, numericise_all([row_values[CURRENT_STOCK_COL - 1]])[0])
+    if stale:
+        # 手作業で行が並べ替えられた場合など。索引ごと作り直す
+        invalidate_product_cache()
+
+def _cached_stock(product_id):
+    entry = _get_product_cache()["by_id"].get(str(product_id))
+    return (entry[0], entry[1].get('current_stock', '')) if entry else (None, None)
+
+def _send_stock_batch(targets, stock_requests, history_rows):
+    """在庫の書き込み (と履歴行) を1回の batchUpdate で送り、競合した商品 id のリストを返します。
+
+    targets は stock_requests と同じ順の [(product_id, 書き込む在庫数), ...]。結果の分からない
+    エラーのときは送り直さず、在庫セルを読み直して書き込む値になっていない商品を競合とします。
+    """
+    body = {"requests": stock_requests + ([_history_append_request(history_rows)] if history_rows else [])}
     try:
-        cell = products_sheet.find(product_code, in_column=2)
-        if cell:
-            row_values = products_sheet.row_values(cell.row)
-            headers = products_sheet.row_values(1)
-            return dict(zip(headers, row_values))
-        return None
-    except gspread.exceptions.CellNotFound:
-        return None
+        if history_rows:
+            response = _call_with_history(_spreadsheet().batch_update, history_rows, body)
+        else:
+            response = _call_write(_spreadsheet().batch_update, body)
+    except Exception as e:
+        if history_rows or not _outcome_unknown(e):
+            raise
+        response = None
+    if response is None:
+        _reload_stock_rows([product_id for product_id, _ in targets])
+        return [product_id for product_id, new_stock in targets if _cached_stock(product_id)[1] != new_stock]
+    conflicts = []
+    for (product_id, new_stock), reply in zip(targets, response.get("replies", [])):
+        if "findReplace" in reply and not reply["findReplace"].get("occurrencesChanged"):
+            conflicts.append(product_id)
+        else:
+            _set_cached_stock(product_id, new_stock)
+    return conflicts
 
+def _commit_stock_changes(changes, history_rows=(), on_batch=None):
+    """在庫数の増減 [(product_id, 増減数), ...] と履歴行をまとめて書き込みます。
+
+    初回は在庫と履歴を1回の batchUpdate で送り、競合した商品だけ読み直して再試行します。
+    見つからない商品は無視します。on_batch を渡すと、batchUpdate が反映されるたびに、その回で
+    在庫を書き込めた商品 id のリストを渡して呼びます (初回の呼び出し時点で履歴行は書き込み済み)。
+    """
+    totals = {}
+    for product_id, quantity_change in changes:
+        totals[str(product_id)] = totals.get(str(product_id), 0) + quantity_change
+    with _stock_write_lock:
+        pending = dict(totals)
+        history_rows = list(history_rows)
+        for attempt in range(STOCK_CAS_RETRIES + 1):
+            stock_requests, targets = [], []
+            for product_id, quantity_change in pending.items():
+                row, expected = _cached_stock(product_id)
+                if row is None:
+                    continue
+                base = int(expected) if isinstance(expected, (int, float)) else 0
+                if attempt == STOCK_CAS_RETRIES or not isinstance(expected, int):
+                    expected = None  # 再試行を使い切った、または数値でないときは無条件で書く
+                stock_requests.append(_stock_write_request(row, expected, base + quantity_change))
+                targets.append((product_id, base + quantity_change))
+            if not stock_requests and not history_rows:
+                return
+            conflicts = _send_stock_batch(targets, stock_requests, history_rows)
+            history_rows = []
+            if on_batch:
+                on_batch([product_id for product_id, _ in targets if product_id not in conflicts])
+            if not conflicts:
+                return
+            pending = {pid: pending[pid] for pid in conflicts}
+            _reload_stock_rows(conflicts)
+
+@_backend_method
 def update_stock(product_id, quantity_change):
-    try:
-        cell = products_sheet.find(str(product_id), in_column=1)
-        if cell:
-            current_stock_col = 5
-            current_stock_str = products_sheet.cell(cell.row, current_stock_col).value
-            current_stock = int(current_stock_str) if current_stock_str else 0
-            new_stock = current_stock + quantity_change
-            products_sheet.update_cell(cell.row, current_stock_col, new_stock)
-    except gspread.exceptions.CellNotFound:
-        pass
+    _commit_stock_changes([(product_id, quantity_change)])
 
-def add_stock_history(product_id, user_name, change_type, quantity):
+@_backend_method
+def apply_stock_changes(changes, history_rows=(), on_batch=None):
+    """複数商品の在庫の増減 [(product_id, 増減数), ...] と履歴行 (new_history_row() の戻り値) を
+    まとめて書き込みます。on_batch は _commit_stock_changes() と同じです。"""
+    _commit_stock_changes(changes, history_rows, on_batch)
+
+@_backend_method
+def adjust_stock(product_id, quantity_change, user_name, change_type):
+    """在庫数の増減と、それに対応する履歴行を1回のリクエストで記録します。"""
+    history_row = new_history_row(product_id, user_name, change_type, abs(quantity_change))
+    _commit_stock_changes([(product_id, quantity_change)], [history_row])
+
+# --- 履歴IDの採番 ---
+# 履歴シートの行数を数えると記録のたびに履歴全体を読むことになるため、ミリ秒単位の時刻を元に
+# 単調増加する ID を採番する (同じミリ秒内では +1 ずつずらす)。複数のプロセス (アプリの複数の
+# インスタンスなど) が同じミリ秒に採番しても重ならないよう、下3桁にはプロセスごとに乱数で決めた
+# 番号を入れる。値は 2**53 未満に収まるが、数値のセルは表示形式で丸めて読み出されるので、
+# シートには文字列として書く (_history_sheet_row())。
+# 旧来の連番 ID や、番号を入れる前の時刻だけの ID よりも常に大きい。
+HISTORY_ID_NODES = 1000
+_history_id_node = random.SystemRandom().randrange(HISTORY_ID_NODES)
+_history_id_lock = threading.Lock()
+_last_history_seq = 0
+
+def _next_history_id():
+    global _last_history_seq
+    with _history_id_lock:
+        _last_history_seq = max(int(time.time() * 1000), _last_history_seq + 1)
+        return _last_history_seq * HISTORY_ID_NODES + _history_id_node
+
+def _now_jst():
     jst = pytz.timezone('Asia/Tokyo')
-    timestamp = datetime.now(jst).strftime("%Y-%m-%d %H:%M:%S")
-    next_row_num = len(history_sheet.get_all_values()) + 1
-    new_row = [next_row_num - 1, product_id, user_name, change_type, quantity, timestamp, ''] # misc_item_nameは空
-    history_sheet.append_row(new_row, value_input_option='USER_ENTERED')
+    return datetime.now(jst).strftime("%Y-%m-%d %H:%M:%S")
+
+def new_history_row(product_id, user_name, change_type, quantity, misc_item_name=''):
+    """ID と時刻を振った stock_history の1行分 (列の順序どおりのリスト) を返します。"""
+    return [_next_history_id(), product_id, user_name, change_type, quantity, _now_jst(), misc_item_name]
+
+@_backend_method
+def add_stock_history(product_id, user_name, change_type, quantity):
+    new_row = new_history_row(product_id, user_name, change_type, quantity) # misc_item_nameは空
+    with _stock_write_lock:
+        _call_with_history(_history_sheet().append_row, [new_row], _history_sheet_row(new_row),
+                           value_input_option='RAW')
 
 # ▼▼▼ 新しい関数を追加 ▼▼▼
+@_backend_method
 def add_misc_stock_history(user_name, item_name, quantity):
     """その他備品の使用履歴を記録します。"""
-    jst = pytz.timezone('Asia/Tokyo')
-    timestamp = datetime.now(jst).strftime("%Y-%m-%d %H:%M:%S")
-    next_row_num = len(history_sheet.get_all_values()) + 1
     # product_idは空欄にし、misc_item_nameに手入力した品目名を入れる
-    new_row = [next_row_num - 1, '', user_name, 'その他使用', quantity, timestamp, item_name]
-    history_sheet.append_row(new_row, value_input_option='USER_ENTERED')
+    new_row = new_history_row('', user_name, 'その他使用', quantity, item_name)
+    with _stock_write_lock:
+        _call_with_history(_history_sheet().append_row, [new_row], _history_sheet_row(new_row),
+                           value_input_option='RAW')
 
 
-def set_stock_count(product_id, new_quantity):
-    try:
-        cell = products_sheet.find(str(product_id), in_column=1)
-        if cell:
-            current_stock_col = 5
-            products_sheet.update_cell(cell.row, current_stock_col, new_quantity)
-    except gspread.exceptions.CellNotFound:
-        pass
+# 在庫数をそのまま設定したときに残す履歴の種類。quantity はその時点の在庫数 (増減ではない) で、
+# reconcile.py はこの行を起点に履歴を再生する。
+SNAPSHOT_CHANGE_TYPE = 'スナップショット'
+# 古い履歴をアーカイブへ移したときに残す繰越行 (archive.py)。quantity はアーカイブした時点の
+# 在庫数で、スナップショットと同じく再生の起点になる。使用履歴の表示には出さない。
+CARRY_FORWARD_CHANGE_TYPE = '繰越'
+# 起点 (スナップショット) の無かった商品の繰越行。quantity はアーカイブした行の増減の合計で、
+# 負にもなる。再生では入荷と同じく足し合わせる。
+CARRY_FORWARD_DELTA_CHANGE_TYPE = '繰越増減'
+CARRY_FORWARD_TYPES = (CARRY_FORWARD_CHANGE_TYPE, CARRY_FORWARD_DELTA_CHANGE_TYPE)
 
-def get_all_history():
-    """すべての在庫履歴を取得します。"""
-    all_history_records = history_sheet.get_all_records()
-    all_products_records = get_all_products()
-    
-    products_map = {product['id']: product['name'] for product in all_products_records}
-    
-    # ▼▼▼ 履歴表示ロジックを修正 ▼▼▼
-    for record in all_history_records:
+@_backend_method
+def set_stock_counts(counts, user_name=''):
+    """複数商品の在庫数 {product_id: 在庫数} を設定し、スナップショット行とともに1回で書き込みます。"""
+    stock_requests, history_rows, written = [], [], []
+    for product_id, new_quantity in counts.items():
+        row = _find_product_row(product_id)
+        if row is None:
+            continue
+        stock_requests.append(_stock_write_request(row, None, new_quantity))
+        history_rows.append(new_history_row(product_id, user_name, SNAPSHOT_CHANGE_TYPE, new_quantity))
+        written.append((product_id, new_quantity))
+    if not stock_requests:
+        return
+    with _stock_write_lock:
+        _call_with_history(_spreadsheet().batch_update, history_rows,
+                           {"requests": stock_requests + [_history_append_request(history_rows)]})
+        for product_id, new_quantity in written:
+            _set_cached_stock(product_id, new_quantity)
+
+@_backend_method
+def set_stock_count(product_id, new_quantity, user_name=''):
+    set_stock_counts({product_id: new_quantity}, user_name)
+
+# --- 履歴のキャッシュ (差分読み込み) ---
+# 取得済みの履歴行と「次に読む行番号」をプロセス全体で保持し、以降は追記された行だけを
+# 読み込む。差分は既知の最終行から読み、その行が変わっていれば (手作業での編集・削除)
+# 全件を読み直す。さらに HISTORY_CACHE_TTL ごとにも全件を読み直す。
+HISTORY_CACHE_TTL = 600  # 秒
+
+_history_cache_lock = threading.Lock()
+_history_cache = {
+    "loaded_at": 0.0,
+    "headers": [],
+    "records": [],        # シート上の順序 (古い順)
+    "next_row": 2,        # 次に読み込む行番号
+    "last_row_values": [],  # 読み込み済みの最終行 (差分読み込み時の照合用)
+}
+
+def _trim_row(row):
+    row = list(row)
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+def _history_records(rows, headers):
+    records = []
+    for row in rows:
+        if not any(row):
+            continue
+        row = row + [''] * (len(headers) - len(row))
+        records.append(dict(zip(headers, numericise_all(row[:len(headers)]))))
+    return records
+
+def _load_history_cache(values=None):
+    if values is None:
+        values = _call(_history_sheet().get_all_values)
+    headers = values[0] if values else []
+    _history_cache.update(
+        loaded_at=time.time(), headers=headers, records=_history_records(values[1:], headers),
+        next_row=len(values) + 1, last_row_values=_trim_row(values[-1]) if values else [],
+    )
+
+def _history_cache_expired():
+    return time.time() - _history_cache["loaded_at"] > HISTORY_CACHE_TTL or not _history_cache["headers"]
+
+def _history_delta_range():
+    """差分読み込みの範囲 (既知の最終行から下) を A1 形式で返します。"""
+    last_col = rowcol_to_a1(1, len(_history_cache["headers"])).rstrip('0123456789')
+    return f"A{_history_cache['next_row'] - 1}:{last_col}"
+
+def _apply_history_delta(rows):
+    """既知の最終行から下を読んだ結果をキャッシュに追加します。最終行が変わっていれば False。"""
+    rows = [_trim_row(row) for row in rows]
+    if not rows or rows[0] != _history_cache["last_row_values"]:
+        return False
+    new_rows = rows[1:]
+    if new_rows:
+        _history_cache["records"].extend(_history_records(new_rows, _history_cache["headers"]))
+        _history_cache["next_row"] += len(new_rows)
+        _history_cache["last_row_values"] = new_rows[-1]
+    return True
+
+def _refresh_history_cache(refresh=True):
+    """履歴キャッシュを最新にします。通常は前回以降に追記された行だけを読み込みます。
+
+    refresh=False の場合、読み込み済みであれば API を呼ばずにそのまま返します。
+    """
+    with _history_cache_lock:
+        if not refresh and _history_cache["headers"]:
+            return _history_cache
+        if _history_cache_expired():
+            _load_history_cache()
+        elif not _apply_history_delta(_call(_history_sheet().get, _history_delta_range())):
+            _load_history_cache()
+        return _history_cache
+
+def invalidate_history_cache():
+    """次回の参照時に履歴シートを全件読み直させます。"""
+    with _history_cache_lock:
+        _history_cache["loaded_at"] = 0.0
+
+def _parse_timestamp(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S"):
+        try:
+            return datetime.strptime(str(value), fmt)
+        except ValueError:
+            pass
+    return None
+
+def _archived_before(records, start_date):
+    """start_date 以降の一部が、既にアーカイブへ移されているかを返します (繰越行の時刻で判断)。"""
+    for record in records:
+        if record.get('change_type') in CARRY_FORWARD_TYPES:
+            timestamp = _parse_timestamp(record.get('timestamp'))
+            return timestamp is not None and start_date < timestamp.date()
+    return False
+
+@_backend_method
+def get_history(limit=None, start_date=None, end_date=None, user_name=None, refresh=True):
+    """在庫履歴を新しい順に返します。
+
+    start_date / end_date (datetime.date、両端を含む) と user_name で絞り込んだうえで、
+    先頭の limit 件だけに品目名 (name) を付けて返します。refresh=False なら、読み込み済みの
+    キャッシュだけを使います (load_admin_page_data() の直後など)。
+    """
+    records = _refresh_history_cache(refresh)["records"]
+    if start_date and _archived_before(records, start_date):
+        # 期間の一部がアーカイブ済みのときだけ、該当するアーカイブを読む
+        import archive
+        records = archive.read_archived_records(start_date, end_date) + records
+    products_map = {product['id']: product['name'] for product in get_all_products()}
+    history = []
+    # 行は追記順 (= 時刻順) に並んでいるので、末尾から必要な件数だけ見る
+    for record in reversed(records):
+        if record.get('change_type') in CARRY_FORWARD_TYPES:
+            continue
+        if user_name and str(record.get('user_name')) != str(user_name):
+            continue
+        if start_date or end_date:
+            timestamp = _parse_timestamp(record.get('timestamp'))
+            if timestamp is None:
+                continue
+            if start_date and timestamp.date() < start_date:
+                continue
+            if end_date and timestamp.date() > end_date:
+                continue
+        record = dict(record)
         # product_idがあれば、それを元に品目名を取得
         if record.get('product_id') and record['product_id'] in products_map:
             record['name'] = products_map[record['product_id']]
         # なければ、手入力された品目名を使う
         else:
             record['name'] = record.get('misc_item_name', '不明な手動入力品')
-    
-    sorted_history = sorted(all_history_records, key=lambda x: x['timestamp'], reverse=True)
-    return sorted_history
\ No newline at end of file
+        history.append(record)
+        if limit and len(history) >= limit:
+            break
+    return history
+
+@_backend_method
+def get_history_records(refresh=True):
+    """品目名を付けない生の履歴行を、記録順 (古い順) のリストで返します。
+
+    refresh=False のときは get_history() と同じく、キャッシュだけを使います。
+    """
+    return list(_refresh_history_cache(refresh)["records"])
+
+def _history_written(history_rows):
+    """history_rows (new_history_row() の戻り値) のいずれかが既に履歴シートにあるかを返します。
+
+    追記された行を読み込んで確かめます。結果の分からなかった書き込みの確認に使います。
+    """
+    ids = {str(row[0]) for row in history_rows}
+    return any(str(record.get('id')) in ids for record in _refresh_history_cache()["records"])
+
+@_backend_method
+def get_all_history():
+    """すべての在庫履歴を取得します。"""
+    return sorted(get_history(), key=lambda x: x['timestamp'], reverse=True)
+
+
+# --- 管理者ページ用のデータ読み込み ---
+def load_admin_page_data():
+    """管理者ページで使うデータを、必要な範囲だけ1回の batchGet でまとめて読み込みます。
+
+    商品カタログ (期限切れの場合) と履歴 (期限切れなら全件、そうでなければ追記分) を
+    一度に取得してキャッシュへ反映し、{"products": [...]} を返します。履歴は
+    get_history(..., refresh=False) で、追加の API 呼び出しなしに参照できます。
+    """
+    store = _local_store()
+    if store is not None:
+        return {"products": store.get_all_products()}
+    with _product_cache_lock, _history_cache_lock:
+        ranges, loaders = [], []
+        if _product_cache_expired():
+            ranges.append(f"'{_products_sheet().title}'")
+            loaders.append(_load_product_cache)
+        if _history_cache_expired():
+            ranges.append(f"'{_history_sheet().title}'")
+            loaders.append(_load_history_cache)
+        else:
+            ranges.append(f"'{_history_sheet().title}'!{_history_delta_range()}")
+            loaders.append(lambda rows: _apply_history_delta(rows) or _load_history_cache())
+        response = _call(_spreadsheet().values_batch_get, ranges)
+        for loader, value_range in zip(loaders, response.get("valueRanges", [])):
+            loader(value_range.get("values", []))
+        products = list(_product_cache["records"])
+    return {"products": products}
+
+
+# --- 履歴のアーカイブ・書き出し用 (archive.py / export.py から使う) ---
+HISTORY_ARCHIVE_PREFIX = "stock_history_"
+# アーカイブでは行を照合して書き写すので、表示形式で丸められない値 (数値は数値のまま、日時は
+# 表示どおりの文字列) で読む
+EXACT_READ_OPTIONS = {'value_render_option': 'UNFORMATTED_VALUE', 'date_time_render_option': 'FORMATTED_STRING'}
+
+def history_write_lock():
+    """このプロセスからの在庫・履歴の書き込みを止めるロックを返します。"""
+    return _stock_write_lock
+
+def read_history_values():
+    """履歴シートの全セル (見出し行を含む) を、丸めのない値で返します。"""
+    return _call(_history_sheet().get_all_values, **EXACT_READ_OPTIONS)
+
+def replace_history_head(old_rows, new_rows):
+    """履歴シートの見出し行の直後にある old_rows を new_rows に置き換えます (1回の batchUpdate)。
+
+    行の削除と挿入で置き換えるので、読み込んだ後に下へ追記された行はそのまま残ります。書き込みの
+    直前に先頭の行を読み直し、old_rows と違っていれば何もせずに False を返します。
+    呼び出し側で history_write_lock() を持ってください。
+    """
+    sheet = _history_sheet()
+    current = _call(sheet.get, f"2:{len(old_rows) + 1}", **EXACT_READ_OPTIONS) if old_rows else []
+    if [_trim_row(row) for row in current] != [_trim_row(row) for row in old_rows]:
+        return False
+    head_requests = []
+    if old_rows:
+        head_requests.append({"deleteDimension": {"range": {
+            "sheetId": sheet.id, "dimension": "ROWS", "startIndex": 1, "endIndex": 1 + len(old_rows),
+        }}})
+    if new_rows:
+        head_requests.append({"insertDimension": {"range": {
+            "sheetId": sheet.id, "dimension": "ROWS", "startIndex": 1, "endIndex": 1 + len(new_rows),
+        }, "inheritFromBefore": False}})
+        head_requests.append({"updateCells": {
+            "range": {"sheetId": sheet.id, "startRowIndex": 1, "endRowIndex": 1 + len(new_rows), "startColumnIndex": 0},
+            "rows": [{"values": [_to_cell_data(v) for v in _history_sheet_row(numericise_all(list(row)))]}
+                     for row in new_rows],
+            "fields": "userEnteredValue",
+        }})
+    if head_requests:
+        _call_write(_spreadsheet().batch_update, {"requests": head_requests})
+    invalidate_history_cache()
+    return True
+
+def list_history_archives():
+    """アーカイブ用ワークシートの名前の一覧を返します。"""
+    return [ws.title for ws in _call(_spreadsheet().worksheets) if ws.title.startswith(HISTORY_ARCHIVE_PREFIX)]
+
+def archive_row_key(row):
+    """アーカイブ済みかどうかを照合するための、行のキー (全セルを文字列にしたもの) を返します。"""
+    return tuple(str(value) for value in _trim_row(row))
+
+def missing_archive_rows(rows, archived_rows):
+    """rows のうち archived_rows に無い行を返します。
+
+    ID だけでなく全セルの値で照合し、同じ行が複数あるときは数も比べます。
+    """
+    remaining = collections.Counter(archive_row_key(row) for row in archived_rows)
+    missing = []
+    for row in rows:
+        key = archive_row_key(row)
+        if remaining[key]:
+            remaining[key] -= 1
+        else:
+            missing.append(row)
+    return missing
+
+def append_history_archive(title, headers, rows):
+    """アーカイブ用ワークシート title に行を追記します。無ければ見出し行付きで作ります。
+
+    既にある行は追記しません (途中で失敗したアーカイブをやり直した場合など)。書き込んだ後に
+    読み直し、rows がすべてアーカイブにあれば True を返します。rows は read_history_values() で
+    読んだ値をそのまま渡してください。
+    """
+    try:
+        sheet = _call(_spreadsheet().worksheet, title)
+        new_rows = missing_archive_rows(rows, _call(sheet.get_all_values, **EXACT_READ_OPTIONS)[1:])
+    except gspread.exceptions.WorksheetNotFound:
+        sheet = _call_write(_spreadsheet().add_worksheet, title, rows=len(rows) + 1, cols=len(headers))
+        _call_write(sheet.append_row, headers, value_input_option='RAW')
+        new_rows = rows
+    if not new_rows:
+        return True
+    _call_write(sheet.append_rows, [_history_sheet_row(row) for row in new_rows], value_input_option='RAW')
+    return not missing_archive_rows(rows, _call(sheet.get_all_values, **EXACT_READ_OPTIONS)[1:])
+
+def sheet_row_count(title):
+    """ワークシート title の行数 (空の行を含むグリッドの行数) を、シートの情報を読み直して返します。"""
+    return _call(_spreadsheet().worksheet, title).row_count
+
+def read_sheet_rows(title, start_row, end_row):
+    """ワークシート title の start_row〜end_row 行目 (1始まり) の値を返します。値のある行までしか返りません。"""
+    return _call(_worksheet(title).get, f"{start_row}:{end_row}")
+
+def read_history_archive(title):
+    """アーカイブ用ワークシートの全セル (見出し行を含む) を返します。"""
+    return _call(_call(_spreadsheet().worksheet, title).get_all_values)
@@ -0,0 +1,270 @@
+# ==============================================================================
+# export.py
+# ==============================================================================
+# 在庫履歴 (アーカイブを含む) を、品目名・商品コードを付けて CSV / Parquet に書き出す。
+# 履歴は一定行数ずつ読み、絞り込んでから順に書き込むので、履歴全体をメモリに載せない。
+# 管理者メニューからはバックグラウンドのスレッドで一時ファイルへ書き出し、終わったら
+# ダウンロードできるようにする。
+#
+#   python export.py history.csv
+#   python export.py history.parquet --start 2025-04-01 --end 2025-09-30 --product sani --product nabi
+import argparse
+import csv
+import datetime
+import logging
+import os
+import tempfile
+import threading
+import uuid
+import pandas as pd
+import database
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = 5000
+FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+COLUMNS = ['id', 'timestamp', 'product_id', 'product_code', 'name', 'user_name', 'change_type', 'quantity', 'misc_item_name']
+
+
+def _sheet_chunks(title, chunk_rows):
+    """ワークシートを見出し行と chunk_rows 行ずつのレコードのリストに分けて読みます。
+
+    値の取得では末尾の空行が省かれ、途中の行を手で消した所で読み込みが短くなるので、シートの
+    行数までは読み進めます。行数を調べた後に追記された行は、短い読み込みが返るまで読みます。
+    空行は飛ばします。
+    """
+    header_rows = database.read_sheet_rows(title, 1, 1)
+    if not header_rows:
+        return
+    headers = header_rows[0]
+    row_count = database.sheet_row_count(title)
+    start = 2
+    while True:
+        rows = database.read_sheet_rows(title, start, start + chunk_rows - 1)
+        records = [dict(zip(headers, list(row) + [''] * (len(headers) - len(row)))) for row in rows if any(row)]
+        if records:
+            yield records
+        if len(rows) < chunk_rows and start + chunk_rows - 1 >= row_count:
+            break
+        start += chunk_rows
+
+
+def _csv_chunks(path, chunk_rows):
+    with open(path, newline="", encoding="utf-8") as f:
+        chunk = []
+        for record in csv.DictReader(f):
+            chunk.append(record)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _raw_chunks(start_date, end_date, chunk_rows):
+    """アーカイブ (期間に重なるものだけ) と履歴シートの行を、古い順に少しずつ返します。"""
+    import archive
+    for name, source in archive.partitions_for(start_date, end_date):
+        if source == "sheet":
+            yield from _sheet_chunks(name, chunk_rows)
+        else:
+            yield from _csv_chunks(source, chunk_rows)
+    yield from _sheet_chunks(database._history_sheet().title, chunk_rows)
+
+
+def _to_frame(records, products, start_date, end_date, product_ids):
+    """生の履歴行を絞り込み、品目名・商品コードを付けた DataFrame にします。"""
+    df = pd.DataFrame.from_records(records, columns=['id', 'product_id', 'user_name', 'change_type', 'quantity',
+                                                     'timestamp', 'misc_item_name']).fillna('')
+    df = df[~df['change_type'].isin(database.CARRY_FORWARD_TYPES)]
+    df['product_id'] = df['product_id'].astype(str)
+    if product_ids:
+        df = df[df['product_id'].isin(product_ids)]
+    if start_date or end_date:
+        dates = pd.to_datetime(df['timestamp'].astype(str).str.replace('/', '-', regex=False),
+                               format='%Y-%m-%d %H:%M:%S', errors='coerce').dt.date
+        in_range = dates.notna()
+        if start_date:
+            in_range &= dates >= start_date
+        if end_date:
+            in_range &= dates <= end_date
+        df = df[in_range]
+    df = df.assign(
+        id=pd.to_numeric(df['id'], errors='coerce').astype('Int64'),
+        quantity=pd.to_numeric(df['quantity'], errors='coerce').astype('Int64'),
+        product_code=df['product_id'].map(lambda pid: products.get(pid, {}).get('product_code', '')).astype(str),
+        name=df['product_id'].map(lambda pid: products.get(pid, {}).get('name')),
+        user_name=df['user_name'].astype(str),
+        timestamp=df['timestamp'].astype(str),
+        misc_item_name=df['misc_item_name'].astype(str),
+    )
+    # 「その他」の品目は手入力した品目名を使う (get_all_history と同じ)
+    df['name'] = df['name'].fillna(df['misc_item_name']).astype(str)
+    return df[COLUMNS]
+
+
+def iter_history(start_date=None, end_date=None, product_ids=None, chunk_rows=CHUNK_ROWS):
+    """絞り込んだ履歴を古い順に、chunk_rows 行程度ずつの DataFrame で返します。
+
+    product_ids は商品 id の集合 (None ならすべて)。繰越行は含めません。
+    """
+    product_ids = {str(pid) for pid in product_ids} if product_ids else None
+    store = database._local_store()
+    if store is not None:
+        for records in store.iter_history(start_date, end_date, product_ids, chunk_rows):
+            df = pd.DataFrame.from_records(records, columns=COLUMNS)
+            yield df.astype({'product_id': str, 'product_code': str, 'name': str, 'misc_item_name': str})
+        return
+    products = {str(p['id']): p for p in database.get_all_products()}
+    for records in _raw_chunks(start_date, end_date, chunk_rows):
+        df = _to_frame(records, products, start_date, end_date, product_ids)
+        if not df.empty:
+            yield df
+
+
+def write_history(fileobj, fmt="csv", on_progress=None, **filters):
+    """履歴を fileobj (バイナリで開いたファイル) に書き出し、書き出した行数を返します。"""
+    fmt = fmt.lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"対応していない形式です: {fmt}")
+    rows = 0
+    writer = None
+    try:
+        for df in iter_history(**filters):
+            if fmt == "csv":
+                # Excel で開いても文字化けしないよう、先頭に BOM を付ける
+                df.to_csv(fileobj, header=rows == 0, index=False, encoding="utf-8-sig" if rows == 0 else "utf-8")
+            else:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(fileobj, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            rows += len(df)
+            if on_progress:
+                on_progress(rows)
+        if fmt == "csv" and rows == 0:
+            pd.DataFrame(columns=COLUMNS).to_csv(fileobj, index=False, encoding="utf-8-sig")
+        if fmt == "parquet" and writer is None:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            pq.write_table(pa.Table.from_pandas(pd.DataFrame(columns=COLUMNS), preserve_index=False), fileobj)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def export_history(path, fmt=None, **filters):
+    """履歴をファイル path に書き出し、書き出した行数を返します。形式は拡張子から決めます。"""
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower() or "csv"
+    with open(path, "wb") as f:
+        return write_history(f, fmt, **filters)
+
+
+# --- 管理者メニューからのバックグラウンド書き出し ---
+# 終わったジョブは JOB_TTL が過ぎると、一時ファイルごと消す (セッションが閉じられて
+# discard_job() が呼ばれなかった場合も、次にジョブを始めるか状態を見たときに片付く)。
+JOB_TTL = datetime.timedelta(hours=1)
+
+_jobs_lock = threading.Lock()
+_jobs = {}
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _expire_jobs():
+    """終わってから JOB_TTL が過ぎたジョブと、その一時ファイルを消します。"""
+    cutoff = datetime.datetime.now() - JOB_TTL
+    with _jobs_lock:
+        expired = [job_id for job_id, job in _jobs.items() if job["done"] and job["finished"] < cutoff]
+        jobs = [_jobs.pop(job_id) for job_id in expired]
+    for job in jobs:
+        if job["path"]:
+            _remove_file(job["path"])
+
+
+def start_export(fmt="csv", **filters):
+    """一時ファイルへの書き出しをバックグラウンドで始め、ジョブの ID を返します。"""
+    _expire_jobs()
+    job_id = uuid.uuid4().hex
+    fd, path = tempfile.mkstemp(prefix="stock_history_", suffix=f".{fmt}")
+    os.close(fd)
+    job = {"path": path, "format": fmt, "rows": 0, "done": False, "error": None,
+           "started": datetime.datetime.now(), "finished": None}
+
+    def run():
+        try:
+            with open(path, "wb") as f:
+                write_history(f, fmt, on_progress=lambda rows: job.update(rows=rows), **filters)
+        except Exception as e:
+            logger.exception("履歴の書き出しに失敗しました。")
+            # 書きかけのファイルは使えないので、すぐに消す
+            _remove_file(path)
+            job.update(error=str(e), path=None)
+        finally:
+            with _jobs_lock:
+                job.update(done=True, finished=datetime.datetime.now())
+                discarded = job.get("discarded")
+            if discarded:
+                discard_job(job_id)
+
+    with _jobs_lock:
+        _jobs[job_id] = job
+    threading.Thread(target=run, name=f"history-export-{job_id[:8]}", daemon=True).start()
+    return job_id
+
+
+def get_job(job_id):
+    """書き出しジョブの状態 (path, format, rows, done, error) を返します。無い (期限切れを含む) なら None。"""
+    _expire_jobs()
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+def discard_job(job_id):
+    """書き出しジョブと一時ファイルを消します。書き出し中なら、終わったときに消します。"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        if not job["done"]:
+            job["discarded"] = True
+            return
+        del _jobs[job_id]
+    if job["path"]:
+        _remove_file(job["path"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在庫履歴を CSV / Parquet に書き出します")
+    parser.add_argument('output', help="書き出し先のファイル (.csv / .parquet)")
+    parser.add_argument('--format', choices=sorted(FORMATS), help="形式 (省略時は拡張子から)")
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help="開始日 (YYYY-MM-DD)")
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help="終了日 (YYYY-MM-DD)")
+    parser.add_argument('--product', action='append', default=[], help="商品コードで絞り込む (複数指定可)")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help="1回に読み込む行数")
+    args = parser.parse_args()
+
+    product_ids = None
+    if args.product:
+        product_ids = set()
+        for code in args.product:
+            product = database.get_product_by_code(code)
+            if product is None:
+                parser.error(f"商品コード '{code}' が見つかりません。")
+            product_ids.add(product['id'])
+    rows = export_history(args.output, args.format, start_date=args.start, end_date=args.end,
+                          product_ids=product_ids, chunk_rows=args.chunk_rows)
+    print(f"{rows} 行を {args.output} に書き出しました。")
+
+
+if __name__ == '__main__':
+    main()
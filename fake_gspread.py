@@ -0,0 +1,404 @@
+# ==============================================================================
+# fake_gspread.py
+# ==============================================================================
+# Google スプレッドシートの代わりにメモリ上で動く、gspread の Spreadsheet / Worksheet の
+# 代用品。database.py が使う操作だけを持ち、呼び出しのたびに API 呼び出し1回として数える。
+# 遅延 (latency) と 429 (クォータ超過) を人工的に起こせるので、実際のシートに触れずに
+# 往復回数や再試行の動きを確かめられる。
+#
+#   spreadsheet = FakeSpreadsheet(latency=0.05, fail_rate=0.1)
+#   spreadsheet.load("products", [["id", "product_code", ...], ...])
+#   database.use_spreadsheet(spreadsheet)
+import collections
+import io
+import json
+import random
+import re
+import threading
+import time
+import gspread
+import requests
+from gspread.cell import Cell
+from gspread.utils import a1_range_to_grid_range, numericise_all
+
+
+_NUMBER_PATTERN = re.compile(r"-?\d+(\.\d+)?")
+# 表示形式が「自動」のセルで、これ以上の桁の整数は指数表記 (1.79235E+15) で表示される
+SHEETS_EXPONENT_DIGITS = 12
+
+
+def _to_cell(value, user_entered=False):
+    """書き込まれた値を、セルに保存する値 (数値・真偽値・文字列) にします。
+
+    RAW では Python の数値だけが数値のセルになり、USER_ENTERED では数字だけの文字列も数値になります。
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (bool, int, float)):
+        return value
+    value = str(value)
+    if user_entered and _NUMBER_PATTERN.fullmatch(value):
+        return float(value) if "." in value else int(value)
+    if user_entered and value.upper() in ("TRUE", "FALSE"):
+        return value.upper() == "TRUE"
+    return value
+
+
+def _format_number(value, sheets_format=True):
+    """数値のセルを、FORMATTED_VALUE で読み出したときの文字列にします。"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if sheets_format and isinstance(value, int) and len(str(abs(value))) >= SHEETS_EXPONENT_DIGITS:
+        mantissa, exponent = f"{value:.5E}".split("E")
+        return f"{mantissa.rstrip('0').rstrip('.')}E+{int(exponent):02d}"
+    return str(value)
+
+
+def _render(value, value_render_option=None, sheets_format=True):
+    """セルの値を、value_render_option どおりに読み出した値にします。"""
+    if value_render_option == "UNFORMATTED_VALUE":
+        return int(value) if isinstance(value, float) and value.is_integer() else value
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return _format_number(value, sheets_format)
+    return value
+
+
+def _cell_value(cell):
+    """batchUpdate の CellData から、セルに保存する値を取り出します。"""
+    value = cell.get("userEnteredValue") if cell else None
+    if not value:
+        return ""
+    (kind, raw), = value.items()
+    return raw if kind in ("numberValue", "boolValue") else str(raw)
+
+
+def _trim(rows):
+    """値の取得結果と同じく、行末と末尾の空欄を取り除きます。"""
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] == "":
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def _quota_error():
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps({"error": {
+        "code": 429, "status": "RESOURCE_EXHAUSTED",
+        "message": "Quota exceeded for quota metric 'Read requests' (fake)",
+    }}).encode()
+    response.raw = io.BytesIO(response._content)
+    return gspread.exceptions.APIError(response)
+
+
+class FakeWorksheet:
+    """メモリ上のワークシート。セルの値は数値・真偽値・文字列のいずれかで持ちます。"""
+
+    def __init__(self, spreadsheet, sheet_id, title, values=()):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self._rows = [[_to_cell(v, user_entered=True) for v in row] for row in values]
+
+    def __repr__(self):
+        return f"<FakeWorksheet {self.title!r} id:{self.id}>"
+
+    @property
+    def row_count(self):
+        return len(self._rows)
+
+    @property
+    def col_count(self):
+        return max((len(row) for row in self._rows), default=0)
+
+    # --- 内部の読み書き (API 呼び出しとしては数えない) ---
+    def _last_row(self):
+        """値のある最後の行番号 (1始まり) を返します。"""
+        for i in range(len(self._rows), 0, -1):
+            if any(value != "" for value in self._rows[i - 1]):
+                return i
+        return 0
+
+    def _set(self, row, col, value):
+        while len(self._rows) < row:
+            self._rows.append([])
+        cells = self._rows[row - 1]
+        if len(cells) < col:
+            cells.extend([""] * (col - len(cells)))
+        cells[col - 1] = value
+
+    def _get(self, row, col):
+        if row <= len(self._rows) and col <= len(self._rows[row - 1]):
+            return self._rows[row - 1][col - 1]
+        return ""
+
+    def _text(self, value):
+        """セルの値を、画面に表示される (FORMATTED_VALUE で読み出される) 文字列にします。"""
+        return _render(value, sheets_format=self.spreadsheet.sheets_number_format)
+
+    def _rendered(self, rows, value_render_option=None):
+        sheets_format = self.spreadsheet.sheets_number_format
+        return _trim([[_render(v, value_render_option, sheets_format) for v in row] for row in rows])
+
+    def _grid(self, grid_range):
+        """GridRange (終わりを省略可) を (開始行, 終了行, 開始列, 終了列) の 0 始まり半開区間にします。"""
+        return (
+            grid_range.get("startRowIndex", 0), grid_range.get("endRowIndex", max(len(self._rows), 1)),
+            grid_range.get("startColumnIndex", 0), grid_range.get("endColumnIndex", max(self.col_count, 1)),
+        )
+
+    def _read_grid(self, grid_range, value_render_option=None):
+        r0, r1, c0, c1 = self._grid(grid_range)
+        return self._rendered([[self._get(r + 1, c + 1) for c in range(c0, c1)]
+                               for r in range(r0, min(r1, len(self._rows)))], value_render_option)
+
+    def _read_a1(self, a1, value_render_option=None):
+        if not a1:
+            return self._rendered(self._rows, value_render_option)
+        return self._read_grid(a1_range_to_grid_range(a1), value_render_option)
+
+    def _append(self, rows, user_entered=False):
+        start = self._last_row() + 1
+        for offset, row in enumerate(rows):
+            for col, value in enumerate(row, start=1):
+                self._set(start + offset, col, _to_cell(value, user_entered))
+        end = start + len(rows) - 1
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:{gspread.utils.rowcol_to_a1(end, max(len(r) for r in rows) or 1)}",
+                            "updatedRows": len(rows)}}
+
+    # --- gspread.Worksheet と同じ操作 (1回の呼び出し = API 呼び出し1回) ---
+    def get_all_values(self, value_render_option=None, **kwargs):
+        self.spreadsheet._request("get_all_values")
+        rows = self._rendered(self._rows, value_render_option)
+        width = max((len(row) for row in rows), default=0)
+        return [row + [""] * (width - len(row)) for row in rows]
+
+    def get_all_records(self, head=1, default_blank="", numericise_ignore=(), value_render_option=None, **kwargs):
+        self.spreadsheet._request("get_all_records")
+        rows = self._rendered(self._rows, value_render_option)
+        if len(rows) < head:
+            return []
+        headers = rows[head - 1]
+        ignore = list(range(1, len(headers) + 1)) if "all" in numericise_ignore else list(numericise_ignore)
+        return [
+            dict(zip(headers, numericise_all(row + [""] * (len(headers) - len(row)), default_blank=default_blank,
+                                             ignore=ignore)))
+            for row in rows[head:]
+        ]
+
+    def get(self, range_name=None, value_render_option=None, **kwargs):
+        self.spreadsheet._request("get")
+        return self._read_a1(range_name, value_render_option)
+
+    def batch_get(self, ranges, value_render_option=None, **kwargs):
+        self.spreadsheet._request("batch_get")
+        return [self._read_a1(a1, value_render_option) for a1 in ranges]
+
+    def row_values(self, row, value_render_option=None, **kwargs):
+        self.spreadsheet._request("row_values")
+        rows = self._rendered(self._rows[row - 1:row], value_render_option)
+        return rows[0] if rows else []
+
+    def col_values(self, col, value_render_option=None):
+        self.spreadsheet._request("col_values")
+        values = [_render(self._get(r, col), value_render_option, self.spreadsheet.sheets_number_format)
+                  for r in range(1, len(self._rows) + 1)]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def cell(self, row, col, value_render_option=None):
+        self.spreadsheet._request("cell")
+        return Cell(row, col, _render(self._get(row, col), value_render_option, self.spreadsheet.sheets_number_format))
+
+    def find(self, query, in_row=None, in_column=None, case_sensitive=True):
+        self.spreadsheet._request("find")
+        for r, row in enumerate(self._rows, start=1):
+            if in_row and r != in_row:
+                continue
+            for c, value in enumerate(row, start=1):
+                if in_column and c != in_column:
+                    continue
+                text = self._text(value)
+                if text == str(query) or (not case_sensitive and text.lower() == str(query).lower()):
+                    return Cell(r, c, text)
+        return None
+
+    def update_cell(self, row, col, value):
+        self.spreadsheet._request("update_cell")
+        self._set(row, col, _to_cell(value, user_entered=True))
+
+    def append_row(self, values, value_input_option="RAW", **kwargs):
+        self.spreadsheet._request("append_row")
+        return self._append([values], user_entered=value_input_option == "USER_ENTERED")
+
+    def append_rows(self, values, value_input_option="RAW", **kwargs):
+        self.spreadsheet._request("append_rows")
+        return self._append(values, user_entered=value_input_option == "USER_ENTERED")
+
+
+class FakeSpreadsheet:
+    """メモリ上のスプレッドシート。API 呼び出しを操作名ごとに数えます。
+
+    latency: 1回の呼び出しにかかる秒数 (jitter 秒までのゆらぎを加える)
+    fail_rate: 呼び出しが 429 で失敗する確率。fail_every を指定すると N 回に1回失敗する
+    sheets_number_format: True なら、FORMATTED_VALUE (既定) で読み出す 12 桁以上の数値を実際の
+        シートと同じく指数表記 (1.79235E+15) にする。False なら桁を省略せずに返す
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, fail_rate=0.0, fail_every=0, seed=0, sheets_number_format=True):
+        self.id = "fake-spreadsheet"
+        self.title = "fake"
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.fail_every = fail_every
+        self.sheets_number_format = sheets_number_format
+        self.calls = collections.Counter()
+        self.failures = 0
+        self._sheets = {}
+        self._next_sheet_id = 0
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def _request(self, op):
+        """API 呼び出し1回分: 数えて、遅延させ、必要なら 429 を起こします。"""
+        with self._lock:
+            self.calls[op] += 1
+            total = sum(self.calls.values())
+            fail = (self.fail_every and total % self.fail_every == 0) or \
+                (self.fail_rate and self._random.random() < self.fail_rate)
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+            if fail:
+                self.failures += 1
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise _quota_error()
+
+    # --- 準備と集計 (API 呼び出しとしては数えない) ---
+    def load(self, title, values):
+        """ワークシート title を values (見出し行を含むリストのリスト) で作り直します。"""
+        with self._lock:
+            sheet = self._sheets.get(title)
+            if sheet is None:
+                sheet = FakeWorksheet(self, self._next_sheet_id, title)
+                self._sheets[title] = sheet
+                self._next_sheet_id += 1
+            sheet._rows = [[_to_cell(v, user_entered=True) for v in row] for row in values]
+            return sheet
+
+    def values(self, title):
+        """ワークシートの全セルを、画面に表示される文字列で返します (確認用)。"""
+        sheet = self._sheets[title]
+        return sheet._rendered(sheet._rows)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.failures = 0
+
+    # --- gspread.Spreadsheet と同じ操作 ---
+    def worksheet(self, title):
+        self._request("worksheet")
+        if title not in self._sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def worksheets(self, **kwargs):
+        self._request("worksheets")
+        return list(self._sheets.values())
+
+    def add_worksheet(self, title, rows=1000, cols=26, index=None):
+        self._request("add_worksheet")
+        with self._lock:
+            if title in self._sheets:
+                raise ValueError(f"ワークシート {title!r} は既にあります")
+        return self.load(title, [])
+
+    def values_batch_get(self, ranges, params=None):
+        self._request("values_batch_get")
+        value_render_option = (params or {}).get("valueRenderOption")
+        value_ranges = []
+        for name in ranges:
+            title, _, a1 = name.partition("!")
+            sheet = self._sheets[title.strip("'")]
+            value_ranges.append({"range": name, "values": sheet._read_a1(a1, value_render_option)})
+        return {"spreadsheetId": self.id, "valueRanges": value_ranges}
+
+    def batch_update(self, body):
+        self._request("batch_update")
+        by_id = {sheet.id: sheet for sheet in self._sheets.values()}
+        replies = []
+        with self._lock:
+            for request in body["requests"]:
+                (kind, params), = request.items()
+                handler = getattr(self, f"_apply_{kind}", None)
+                if handler is None:
+                    raise NotImplementedError(f"batchUpdate の {kind} には対応していません")
+                replies.append(handler(by_id, params))
+        return {"spreadsheetId": self.id, "replies": replies}
+
+    def _apply_findReplace(self, by_id, params):
+        grid_range = params["range"]
+        sheet = by_id[grid_range["sheetId"]]
+        r0, r1, c0, c1 = sheet._grid(grid_range)
+        changed = 0
+        # 検索は画面に表示される文字列に対して行われ、置換後の文字列は入力した値として解釈される
+        for r in range(r0, r1):
+            for c in range(c0, c1):
+                text = sheet._text(sheet._get(r + 1, c + 1))
+                if params.get("matchEntireCell") and text == params["find"]:
+                    sheet._set(r + 1, c + 1, _to_cell(params["replacement"], user_entered=True))
+                    changed += 1
+                elif not params.get("matchEntireCell") and text != "" and params["find"] in text:
+                    sheet._set(r + 1, c + 1, _to_cell(text.replace(params["find"], params["replacement"]),
+                                                      user_entered=True))
+                    changed += 1
+        return {"findReplace": {"occurrencesChanged": changed, "valuesChanged": changed} if changed else {}}
+
+    def _apply_updateCells(self, by_id, params):
+        grid_range = params["range"]
+        sheet = by_id[grid_range["sheetId"]]
+        rows = params.get("rows", [])
+        r0, r1, c0, c1 = sheet._grid(grid_range)
+        # 範囲のうち rows で埋まらない部分は消去される (範囲の終わりを省略した場合はシートの端まで)
+        r1 = max(r1, r0 + len(rows)) if "endRowIndex" not in grid_range else r1
+        for r in range(r0, r1):
+            cells = rows[r - r0].get("values", []) if r - r0 < len(rows) else []
+            width = c1 - c0 if "endColumnIndex" in grid_range else max(c1 - c0, len(cells))
+            for c in range(width):
+                value = _cell_value(cells[c]) if c < len(cells) else ""
+                if value != "" or sheet._get(r + 1, c0 + c + 1) != "":
+                    sheet._set(r + 1, c0 + c + 1, value)
+        return {}
+
+    def _apply_deleteDimension(self, by_id, params):
+        dimension_range = params["range"]
+        sheet = by_id[dimension_range["sheetId"]]
+        if dimension_range["dimension"] != "ROWS":
+            raise NotImplementedError("deleteDimension は行だけに対応しています")
+        del sheet._rows[dimension_range["startIndex"]:dimension_range["endIndex"]]
+        return {}
+
+    def _apply_insertDimension(self, by_id, params):
+        dimension_range = params["range"]
+        sheet = by_id[dimension_range["sheetId"]]
+        if dimension_range["dimension"] != "ROWS":
+            raise NotImplementedError("insertDimension は行だけに対応しています")
+        start, end = dimension_range["startIndex"], dimension_range["endIndex"]
+        sheet._rows[start:start] = [[] for _ in range(end - start)]
+        return {}
+
+    def _apply_appendCells(self, by_id, params):
+        sheet = by_id[params["sheetId"]]
+        sheet._append([[_cell_value(cell) for cell in row.get("values", [])] for row in params.get("rows", [])])
+        return {}
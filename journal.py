@@ -0,0 +1,268 @@
+# ==============================================================================
+# journal.py
+# ==============================================================================
+# 使用・在庫調整の記録を、まずローカルの追記専用ジャーナル (SQLite、コミットごとに fsync)
+# に書き込んで即座に確定させ、バックグラウンドのワーカーがまとめてスプレッドシートへ
+# 反映する。Sheets が遅い・クォータ超過のときもボタン操作はローカルディスクの速さで終わる。
+#
+# 各イベントには記録時に履歴 ID (stock_history の id 列) を振っておき、これを冪等キーとして
+# 使う。反映中は batchUpdate が反映されるたびに、履歴行を書き込んだこと (history_written) と
+# 在庫数に反映できたこと (stock_applied) をイベントごとに記録する。反映が途中で失敗した
+# イベントは、履歴行が書き込み済みなら在庫数だけを送り直す。結果の分からないまま終わった
+# イベントは、その ID の行が既に履歴シートにあるかを確かめてから再送するので、二重に数えない。
+import logging
+import sqlite3
+import threading
+import streamlit as st
+import database
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 2.0      # 秒。記録が無くてもこの間隔で未反映分を確認する
+FLUSH_BATCH_SIZE = 200    # 1回の反映で送るイベント数の上限
+RETRY_BACKOFF_MAX = 60.0  # 秒
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    history_id INTEGER PRIMARY KEY,
+    product_id TEXT NOT NULL DEFAULT '',
+    quantity_change INTEGER NOT NULL DEFAULT 0,
+    user_name TEXT NOT NULL DEFAULT '',
+    change_type TEXT NOT NULL DEFAULT '',
+    quantity INTEGER NOT NULL DEFAULT 0,
+    timestamp TEXT NOT NULL,
+    misc_item_name TEXT NOT NULL DEFAULT '',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    history_written INTEGER NOT NULL DEFAULT 0,
+    stock_applied INTEGER NOT NULL DEFAULT 0,
+    flushed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_events_pending ON events (flushed, history_id);
+"""
+
+
+def _sheet_value(value):
+    """ジャーナルに文字列で保存した ID を、シートに書く値 (数字なら int) に戻します。"""
+    return int(value) if str(value).isdigit() else value
+
+
+class Journal:
+    """ローカルの書き込み先行ジャーナルと、その内容を Sheets へ反映するワーカー。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # ワーカーと手動・終了時の反映が同じイベントを送らないように
+        self._wake = threading.Event()
+        self._worker = None
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+            # 反映状況の列が無いころに作ったジャーナルには列を足す
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(events)")}
+            for column in ('history_written', 'stock_applied'):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE events ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    # --- 記録 (画面側から呼ぶ) ---
+    def record(self, product_id, quantity_change, user_name, change_type):
+        """在庫の増減を1件記録します。ジャーナルへの書き込みが終わった時点で戻ります。"""
+        self.record_many([(product_id, quantity_change)], user_name, change_type)
+
+    def record_many(self, changes, user_name, change_type):
+        """[(product_id, 増減数), ...] を1つのトランザクションで記録します。"""
+        rows = []
+        for product_id, quantity_change in changes:
+            if not quantity_change:
+                continue
+            history_row = database.new_history_row(product_id, user_name, change_type, abs(quantity_change))
+            rows.append((history_row[0], str(product_id), quantity_change, user_name, change_type,
+                         history_row[4], history_row[5]))
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO events (history_id, product_id, quantity_change, user_name, change_type,"
+                        " quantity, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+            finally:
+                conn.close()
+        self.start()
+        self._wake.set()
+
+    def pending_changes(self):
+        """まだ Sheets に反映されていない在庫の増減を {product_id: 合計} で返します。"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT product_id, SUM(quantity_change) AS total FROM events"
+                " WHERE flushed = 0 AND stock_applied = 0 GROUP BY product_id"
+            ).fetchall()
+        finally:
+            conn.close()
+        return {row['product_id']: row['total'] for row in rows}
+
+    def apply_pending(self, products):
+        """商品レコードのリストについて、current_stock に未反映分を足したコピーを返します。"""
+        pending_changes = self.pending_changes()
+        results = []
+        for product in products:
+            product = dict(product)
+            pending = pending_changes.get(str(product.get('id')), 0)
+            if pending:
+                try:
+                    product['current_stock'] = int(product.get('current_stock') or 0) + pending
+                except (ValueError, TypeError):
+                    pass
+            results.append(product)
+        return results
+
+    # --- 反映 (ワーカーから呼ぶ) ---
+    def _pending_events(self):
+        conn = self._connect()
+        try:
+            return [dict(row) for row in conn.execute(
+                "SELECT * FROM events WHERE flushed = 0 ORDER BY history_id LIMIT ?", (FLUSH_BATCH_SIZE,)
+            )]
+        finally:
+            conn.close()
+
+    def _update_events(self, sql, history_ids):
+        if not history_ids:
+            return
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(sql, [(history_id,) for history_id in history_ids])
+            finally:
+                conn.close()
+
+    def flush(self):
+        """未反映のイベントを最大 FLUSH_BATCH_SIZE 件、1回の batchUpdate で反映します。
+
+        反映したイベント数を返します。Sheets のエラーはそのまま送出します。
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        events = self._pending_events()
+        if not events:
+            return 0
+        # 前回の反映が途中で失敗したイベントのうち、在庫数に反映済みのものは確定させる
+        done = {e['history_id'] for e in events if e['stock_applied']}
+        # 結果が分からないまま終わったイベントは、履歴にあれば batchUpdate 全体が反映されている
+        unknown = [e for e in events if e['attempts'] and not e['history_written'] and not e['stock_applied']]
+        if unknown:
+            written_ids = {str(record.get('id')) for record in database.get_history_records()}
+            found = {e['history_id'] for e in unknown if str(e['history_id']) in written_ids}
+            if found:
+                logger.warning("応答の無かった反映 %d 件が履歴にあったため、反映済みとして扱います。"
+                               "在庫数は検算で確かめてください。", len(found))
+            done |= found
+        self._update_events("UPDATE events SET flushed = 1 WHERE history_id = ?", sorted(done))
+        events = [e for e in events if e['history_id'] not in done]
+        if not events:
+            return 0
+        history_ids = [event['history_id'] for event in events]
+        unwritten_ids = [event['history_id'] for event in events if not event['history_written']]
+        by_product = {}
+        for event in events:
+            by_product.setdefault(str(event['product_id']), []).append(event['history_id'])
+        self._update_events("UPDATE events SET attempts = attempts + 1 WHERE history_id = ?", history_ids)
+
+        def on_batch(applied_product_ids):
+            # 最初の batchUpdate で履歴行は書き込まれる。以降は在庫数を書き込めた商品の分だけ記録する
+            self._update_events("UPDATE events SET history_written = 1 WHERE history_id = ?", unwritten_ids)
+            unwritten_ids.clear()
+            self._update_events("UPDATE events SET stock_applied = 1 WHERE history_id = ?",
+                                [hid for pid in applied_product_ids for hid in by_product.get(str(pid), [])])
+
+        # 履歴行が書き込み済みのイベント (前回、在庫数の書き込みだけが失敗した) は在庫数だけを送る
+        database.apply_stock_changes(
+            [(event['product_id'], event['quantity_change']) for event in events],
+            [[event['history_id'], _sheet_value(event['product_id']), event['user_name'], event['change_type'],
+              event['quantity'], event['timestamp'], event['misc_item_name']]
+             for event in events if not event['history_written']],
+            on_batch=on_batch,
+        )
+        self._update_events("UPDATE events SET flushed = 1 WHERE history_id = ?", history_ids)
+        return len(events)
+
+    def _run(self):
+        backoff = FLUSH_INTERVAL
+        while True:
+            self._wake.wait(backoff)
+            self._wake.clear()
+            try:
+                while self.flush() == FLUSH_BATCH_SIZE:
+                    pass
+                backoff = FLUSH_INTERVAL
+            except Exception:
+                backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+                logger.exception("ジャーナルの反映に失敗しました。%.0f 秒後に再試行します。", backoff)
+
+    def start(self):
+        """反映用のワーカースレッドを (まだ動いていなければ) 起動します。"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="stock-journal", daemon=True)
+                self._worker.start()
+
+
+@st.cache_resource(show_spinner=False)
+def get_journal():
+    """プロセスで1つのジャーナルを返します。前回の起動で未反映のまま残った分も反映を始めます。"""
+    journal = Journal(database.get_setting("journal_path", "stock_journal.db"))
+    journal.start()
+    return journal
+
+
+def _enabled():
+    # SQLite バックエンドは書き込み自体がローカルなので、ジャーナルを通さない
+    return database.STORAGE_BACKEND != "sqlite"
+
+
+def start():
+    """アプリ起動時に呼び、前回の未反映分があれば反映を始めます。"""
+    if _enabled():
+        get_journal()
+
+
+def record_usage(product_id, quantity_change, user_name, change_type):
+    """在庫の増減を記録します。"""
+    if _enabled():
+        get_journal().record(product_id, quantity_change, user_name, change_type)
+    else:
+        database.adjust_stock(product_id, quantity_change, user_name, change_type)
+
+
+def record_usages(changes, user_name, change_type):
+    """複数商品の増減 [(product_id, 増減数), ...] をまとめて記録します (1回の反映で書き込まれます)。"""
+    if _enabled():
+        get_journal().record_many(changes, user_name, change_type)
+    else:
+        database.apply_stock_changes(
+            changes,
+            [database.new_history_row(product_id, user_name, change_type, abs(quantity_change))
+             for product_id, quantity_change in changes if quantity_change],
+        )
+
+
+def with_pending(products):
+    """表示用に、未反映の増減を current_stock に含めた商品レコードのリストを返します。"""
+    return get_journal().apply_pending(products) if _enabled() else list(products)
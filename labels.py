@@ -0,0 +1,129 @@
+# ==============================================================================
+# labels.py
+# ==============================================================================
+# 商品の QR コードを、品目名と商品コード付きのラベルとして A4 の台紙に並べ、印刷用の
+# PNG / PDF を作る。QR コードの画像は (base_url, product_code) ごとに、台紙は内容ごとに
+# メモ化するので、再実行や同じ台紙の印刷し直しでは作り直さない。
+import functools
+import io
+import os
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+import database
+
+PAGE_SIZE_MM = (210, 297)  # A4
+DEFAULT_DPI = 200
+DEFAULT_COLUMNS = 4
+DEFAULT_ROWS = 6
+MARGIN_MM = 8
+# 日本語の品目名を描ける字体。label_font_path の設定が優先される
+FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "C:/Windows/Fonts/meiryo.ttc",
+    "C:/Windows/Fonts/msgothic.ttc",
+]
+
+
+def product_url(base_url, product_code):
+    """QR コードに埋め込む URL を返します。"""
+    return f"{base_url}?product_code={product_code}"
+
+
+@functools.lru_cache(maxsize=2048)
+def qr_image(base_url, product_code):
+    """QR コードの画像 (白黒、余白1セル) を返します。呼び出し側で変更しないでください。"""
+    qr = qrcode.QRCode(border=1, box_size=10)
+    qr.add_data(product_url(base_url, product_code))
+    qr.make(fit=True)
+    return qr.make_image(fill_color="black", back_color="white").get_image().convert('L')
+
+
+@functools.lru_cache(maxsize=512)
+def qr_png(base_url, product_code):
+    """1つの QR コードの PNG (qrcode.make() と同じ見た目) を返します。"""
+    buf = io.BytesIO()
+    qrcode.make(product_url(base_url, product_code)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+@functools.lru_cache(maxsize=8)
+def _font(size):
+    paths = [database.get_setting("label_font_path", "")] + FONT_CANDIDATES
+    for path in paths:
+        if path and os.path.exists(path):
+            try:
+                return ImageFont.truetype(path, size)
+            except OSError:
+                continue
+    # 日本語の字体が見つからない場合 (品目名は表示できない文字が豆腐になる)
+    return ImageFont.load_default(size)
+
+
+def _fit_text(draw, text, font, width):
+    """幅に収まらない文字列を末尾を「…」にして切り詰めます。"""
+    if draw.textlength(text, font=font) <= width:
+        return text
+    while text and draw.textlength(text + "…", font=font) > width:
+        text = text[:-1]
+    return text + "…"
+
+
+def _render_pages(base_url, items, columns, rows, dpi):
+    px_per_mm = dpi / 25.4
+    page_w, page_h = (round(v * px_per_mm) for v in PAGE_SIZE_MM)
+    margin = round(MARGIN_MM * px_per_mm)
+    cell_w, cell_h = (page_w - 2 * margin) // columns, (page_h - 2 * margin) // rows
+    padding = max(4, cell_w // 20)
+    name_font, code_font = _font(max(10, cell_h // 11)), _font(max(9, cell_h // 14))
+    caption_h = name_font.size + code_font.size + padding * 2
+    qr_side = max(1, min(cell_w - 2 * padding, cell_h - caption_h - padding))
+
+    pages = []
+    per_page = columns * rows
+    for start in range(0, len(items), per_page):
+        page = Image.new('L', (page_w, page_h), 255)
+        draw = ImageDraw.Draw(page)
+        for i, (code, name) in enumerate(items[start:start + per_page]):
+            x = margin + (i % columns) * cell_w
+            y = margin + (i // columns) * cell_h
+            # 切り取り用の薄い枠
+            draw.rectangle([x, y, x + cell_w - 1, y + cell_h - 1], outline=200)
+            qr = qr_image(base_url, code).resize((qr_side, qr_side), Image.NEAREST)
+            page.paste(qr, (x + (cell_w - qr_side) // 2, y + padding))
+            text_y = y + padding + qr_side + padding // 2
+            for text, font in ((name, name_font), (code, code_font)):
+                text = _fit_text(draw, str(text), font, cell_w - 2 * padding)
+                draw.text((x + cell_w // 2, text_y), text, fill=0, font=font, anchor="ma")
+                text_y += font.size + padding // 2
+        pages.append(page)
+    return pages
+
+
+@functools.lru_cache(maxsize=16)
+def _label_sheet(base_url, items, fmt, columns, rows, dpi):
+    pages = _render_pages(base_url, items, columns, rows, dpi)
+    buf = io.BytesIO()
+    if fmt == "PDF":
+        pages[0].save(buf, format='PDF', save_all=True, append_images=pages[1:], resolution=dpi)
+    else:
+        # PNG は1枚の画像にしかできないので、ページを縦につなげる
+        sheet = Image.new('L', (pages[0].width, pages[0].height * len(pages)), 255)
+        for i, page in enumerate(pages):
+            sheet.paste(page, (0, page.height * i))
+        sheet.save(buf, format='PNG', dpi=(dpi, dpi), optimize=False)
+    return buf.getvalue()
+
+
+def label_sheet(products, base_url, fmt="PDF", columns=DEFAULT_COLUMNS, rows=DEFAULT_ROWS, dpi=DEFAULT_DPI):
+    """商品のリストから、ラベルを並べた台紙 (PDF は1ページ columns×rows 枚) のバイト列を返します。
+
+    fmt は "PDF" または "PNG"。商品が無ければ None を返します。
+    """
+    items = tuple((str(p['product_code']), str(p['name'])) for p in products)
+    if not items:
+        return None
+    return _label_sheet(base_url, items, fmt.upper(), int(columns), int(rows), int(dpi))
@@ -0,0 +1,175 @@
+# ==============================================================================
+# metrics.py
+# ==============================================================================
+# Sheets API 呼び出しの計測。database._call() が呼び出し (再試行を含む1回ごと) を記録し、
+# 操作名・呼び出し元の関数・所要時間・応答の大きさ (セル数) を集計する。直近1分間の
+# 呼び出し回数をクォータと比べて管理者メニューに表示し、遅い呼び出しは警告ログに出す。
+# 設定 metrics_path があれば、1回ごとの記録を JSON Lines で追記する。
+#
+# 再実行の計測: プロファイルを有効にすると、app.py の mark() で区切った処理ごとの
+# 所要時間と API 呼び出し回数を、直前の再実行の分だけ表示できる。Streamlit は再実行を
+# セッションごとのスレッドで行うので、呼び出し回数はスレッドごとに数え、ほかのセッションや
+# ジャーナルのワーカーによる呼び出しは含めない。
+import collections
+import json
+import logging
+import threading
+import time
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+QUOTA_PER_MINUTE = 60      # Sheets API の1分あたりの上限 (ユーザーごとの読み取り・書き込み)
+SLOW_CALL_SECONDS = 2.0    # これより時間のかかった呼び出しを「遅い」とする
+RECENT_CALLS = 500         # 直近の呼び出しを何件まで覚えておくか
+
+_lock = threading.Lock()
+_file_lock = threading.Lock()
+_recent = collections.deque(maxlen=RECENT_CALLS)   # 直近の呼び出しの記録 (dict)
+_minute = collections.deque()                       # 直近1分間の呼び出し時刻
+_totals = {}                                        # (op, caller) -> 集計
+_state = {"settings": None}
+_thread_state = threading.local()                   # calls: このスレッドからの呼び出し回数
+
+
+def _settings():
+    if _state["settings"] is None:
+        import database
+        _state["settings"] = {
+            "quota": int(database.get_setting("sheets_quota_per_minute", QUOTA_PER_MINUTE)),
+            "slow": float(database.get_setting("slow_call_seconds", SLOW_CALL_SECONDS)),
+            "path": database.get_setting("metrics_path", ""),
+            "profile": str(database.get_setting("profile_reruns", "")).lower() in ("1", "true", "yes", "on"),
+        }
+    return _state["settings"]
+
+
+def response_size(result):
+    """応答の大きさをセル数 (書き込みなら更新・追記した要素数) で返します。"""
+    if isinstance(result, list):
+        return sum(len(row) if isinstance(row, list) else 1 for row in result)
+    if isinstance(result, dict):
+        if "valueRanges" in result:
+            return sum(response_size(r.get("values", [])) for r in result["valueRanges"])
+        if "replies" in result:
+            return len(result["replies"])
+        if "updates" in result:
+            return result["updates"].get("updatedCells", 0)
+    return 0
+
+
+def record_call(func, caller, seconds, result=None, error=None):
+    """API 呼び出し1回分を記録します。"""
+    settings = _settings()
+    now = time.time()
+    entry = {
+        "time": now,
+        "op": getattr(func, "__name__", str(func)),
+        "target": getattr(getattr(func, "__self__", None), "title", ""),
+        "caller": caller,
+        "ms": round(seconds * 1000, 1),
+        "size": response_size(result) if error is None else 0,
+        "status": "ok" if error is None else getattr(getattr(error, "response", None), "status_code", type(error).__name__),
+        "slow": seconds >= settings["slow"],
+    }
+    _thread_state.calls = _thread_calls() + 1
+    with _lock:
+        _recent.append(entry)
+        _minute.append(now)
+        while _minute and _minute[0] < now - 60:
+            _minute.popleft()
+        total = _totals.setdefault((entry["op"], caller), {"count": 0, "errors": 0, "ms": 0.0, "max_ms": 0.0, "size": 0})
+        total["count"] += 1
+        total["errors"] += error is not None
+        total["ms"] += entry["ms"]
+        total["max_ms"] = max(total["max_ms"], entry["ms"])
+        total["size"] += entry["size"]
+        per_minute = len(_minute)
+    if entry["slow"]:
+        logger.warning("遅い Sheets API 呼び出し: %s.%s (%s から) %.0f ms", entry["target"], entry["op"], caller, entry["ms"])
+    if per_minute == int(settings["quota"] * 0.8):
+        logger.warning("直近1分間の Sheets API 呼び出しがクォータの8割 (%d 回) に達しました。", per_minute)
+    if settings["path"]:
+        line = json.dumps(dict(entry, calls_last_minute=per_minute), ensure_ascii=False)
+        with _file_lock:
+            with open(settings["path"], "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def calls_last_minute():
+    """直近1分間の API 呼び出し回数を返します。"""
+    with _lock:
+        cutoff = time.time() - 60
+        while _minute and _minute[0] < cutoff:
+            _minute.popleft()
+        return len(_minute)
+
+
+def quota_per_minute():
+    return _settings()["quota"]
+
+
+def summary():
+    """(操作, 呼び出し元) ごとの集計を、呼び出し回数の多い順のリストで返します。"""
+    with _lock:
+        rows = [
+            {"op": op, "caller": caller, "count": t["count"], "errors": t["errors"],
+             "avg_ms": round(t["ms"] / t["count"], 1), "max_ms": t["max_ms"], "cells": t["size"]}
+            for (op, caller), t in _totals.items()
+        ]
+    return sorted(rows, key=lambda r: r["count"], reverse=True)
+
+
+def recent_calls(slow_only=False, limit=50):
+    """直近の呼び出し (新しい順) を返します。"""
+    with _lock:
+        calls = [dict(c) for c in reversed(_recent) if c["slow"] or not slow_only]
+    return calls[:limit]
+
+
+def reset():
+    """集計を消します。"""
+    with _lock:
+        _recent.clear()
+        _minute.clear()
+        _totals.clear()
+
+
+# --- 再実行ごとの処理時間 ---
+def _thread_calls():
+    return getattr(_thread_state, "calls", 0)
+
+
+def profiling_enabled():
+    """再実行の計測が有効か (管理者メニューの切り替え、なければ設定 profile_reruns) を返します。"""
+    return bool(st.session_state.get("profile_reruns", _settings()["profile"]))
+
+
+def start_rerun():
+    """再実行の最初に呼びます。プロファイルが有効なら計測を始めます。"""
+    if profiling_enabled():
+        now = time.perf_counter()
+        st.session_state["_rerun_profile"] = {"started": now, "last": now, "calls": _thread_calls(), "phases": []}
+
+
+def mark(name):
+    """前回の mark() (または start_rerun()) から今までを、処理 name として記録します。"""
+    profile = st.session_state.get("_rerun_profile") if profiling_enabled() else None
+    if profile is None:
+        return
+    now = time.perf_counter()
+    calls = _thread_calls()
+    profile["phases"].append({"phase": name, "ms": round((now - profile["last"]) * 1000, 1), "api_calls": calls - profile["calls"]})
+    profile["last"], profile["calls"] = now, calls
+
+
+def finish_rerun():
+    """再実行の最後に呼び、計測結果を last_rerun_profile() で見られるようにします。"""
+    profile = st.session_state.pop("_rerun_profile", None)
+    if profile is not None:
+        st.session_state["_last_rerun_profile"] = profile["phases"]
+
+
+def last_rerun_profile():
+    """直前に最後まで終わった再実行の、処理ごとの所要時間のリストを返します。"""
+    return st.session_state.get("_last_rerun_profile", [])
@@ -0,0 +1,96 @@
+# ==============================================================================
+# qr_scanner.py
+# ==============================================================================
+# streamlit-webrtc のフレームコールバックで使う QR コード読み取り処理。
+# コールバックはワーカースレッドで動くため st.session_state には触れず、読み取った
+# 商品コードはロック付きの受け渡し口に置いて、スクリプト側のスレッドから取り出す。
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+import av
+import cv2
+
+# 読み取りの既定値。アプリでは設定 (qr_sample_every / qr_max_side / qr_debounce_seconds) で変えられる
+SAMPLE_EVERY = 3
+MAX_SIDE = 480
+DEBOUNCE_SECONDS = 3.0
+
+
+def guide_box(width, height):
+    """フレーム中央に描く緑のガイド枠 (x, y, 一辺の長さ) を返します。"""
+    box_size = min(width, height) * 2 // 3
+    return (width - box_size) // 2, (height - box_size) // 2, box_size
+
+
+def parse_product_code(data):
+    """QR コードの URL から product_code を取り出します。無ければ None。"""
+    try:
+        query_params = parse_qs(urlparse(data).query)
+    except Exception:
+        return None
+    codes = query_params.get('product_code')
+    return codes[0] if codes else None
+
+
+class QrScanner:
+    """1つのカメラ映像 (ストリーム) 用の QR 読み取り器。
+
+    - 検出器はストリームごとに1つだけ作って使い回す
+    - ガイド枠の内側だけを、max_side 以下に縮小してから読み取る
+    - sample_every フレームに1回だけ読み取る (枠の描画は毎フレーム)
+    - 同じコードは debounce_seconds の間、重ねて通知しない
+    """
+
+    def __init__(self, sample_every=SAMPLE_EVERY, max_side=MAX_SIDE, debounce_seconds=DEBOUNCE_SECONDS):
+        self.sample_every = max(1, int(sample_every))
+        self.max_side = int(max_side)
+        self.debounce_seconds = float(debounce_seconds)
+        self._detector = cv2.QRCodeDetector()
+        self._frame_count = 0
+        self._last_code = None
+        self._last_code_time = 0.0
+        self._pending_code = None
+        self._code_ready = threading.Condition()
+
+    def decode(self, img):
+        """画像 (BGR) を読み取り、product_code を返します。読み取れなければ None。"""
+        height, width = img.shape[:2]
+        scale = self.max_side / max(height, width) if self.max_side else 1.0
+        if scale < 1.0:
+            img = cv2.resize(img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        data, _, _ = self._detector.detectAndDecode(gray)
+        return parse_product_code(data) if data else None
+
+    def process_image(self, img):
+        """1フレーム分の処理。必要ならガイド枠内を読み取り、枠を描き込みます。"""
+        height, width = img.shape[:2]
+        x, y, box_size = guide_box(width, height)
+        self._frame_count += 1
+        if self._frame_count % self.sample_every == 0:
+            code = self.decode(img[y:y + box_size, x:x + box_size])
+            if code:
+                self._publish(code)
+        cv2.rectangle(img, (x, y), (x + box_size, y + box_size), (0, 255, 0), 2)
+        return img
+
+    def __call__(self, frame: av.VideoFrame) -> av.VideoFrame:
+        img = self.process_image(frame.to_ndarray(format="bgr24"))
+        return av.VideoFrame.from_ndarray(img, format="bgr24")
+
+    def _publish(self, code):
+        now = time.monotonic()
+        if code == self._last_code and now - self._last_code_time < self.debounce_seconds:
+            return
+        self._last_code, self._last_code_time = code, now
+        with self._code_ready:
+            self._pending_code = code
+            self._code_ready.notify_all()
+
+    def pop_code(self, timeout=0):
+        """読み取った商品コードを取り出します。timeout 秒待っても無ければ None。"""
+        with self._code_ready:
+            if self._pending_code is None and timeout:
+                self._code_ready.wait(timeout)
+            code, self._pending_code = self._pending_code, None
+            return code
@@ -0,0 +1,115 @@
+# ==============================================================================
+# reconcile.py
+# ==============================================================================
+# stock_history を再生して商品ごとのあるべき在庫数を求め、products の current_stock と突き合わせる。
+# スナップショット行・繰越行 (quantity = その時点の在庫数) を起点に、
+# それ以降の入荷・使用などを pandas でまとめて足し引きする。前回の検算結果をチェックポイント
+# として覚えておき、次回はそれ以降に追記された行だけを再生する。
+import threading
+import numpy as np
+import pandas as pd
+import database
+
+# 在庫数への影響 (quantity に掛ける符号)。ここに無い種類 (その他使用など) は在庫数に影響しない
+STOCK_EFFECTS = {'入荷': 1, '使用': -1, '棚卸調整': -1, database.CARRY_FORWARD_DELTA_CHANGE_TYPE: 1}
+SNAPSHOT_TYPES = {database.SNAPSHOT_CHANGE_TYPE, database.CARRY_FORWARD_CHANGE_TYPE}
+
+_checkpoint_lock = threading.Lock()
+_checkpoint = {
+    "rows": 0,          # 再生済みの履歴行数
+    "last_id": None,    # 再生済みの最終行の id (履歴が読み直されていないかの照合用)
+    "expected": pd.Series(dtype='int64'),
+    "has_snapshot": set(),
+}
+
+
+def replay(records, expected=None, has_snapshot=()):
+    """履歴行 (古い順) を再生します。
+
+    expected / has_snapshot は records より前の時点の結果 (前回の戻り値)。商品ごとのあるべき
+    在庫数 (product_id の文字列を索引とする Series) と、スナップショットのある商品の集合を返します。
+    """
+    expected = pd.Series(dtype='int64') if expected is None else expected
+    has_snapshot = set(has_snapshot)
+    if not records:
+        return expected, has_snapshot
+    df = pd.DataFrame.from_records(records, columns=['product_id', 'change_type', 'quantity'])
+    df['product_id'] = df['product_id'].astype(str)
+    df = df[df['product_id'] != ''].reset_index(drop=True)
+    df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce').fillna(0).astype('int64')
+    df['pos'] = np.arange(len(df))
+    is_snapshot = df['change_type'].isin(SNAPSHOT_TYPES)
+
+    # 商品ごとに最後のスナップショットを起点とし、それより後の行だけを足し引きする
+    last_snapshots = df[is_snapshot].drop_duplicates('product_id', keep='last').set_index('product_id')
+    last_snapshot_pos = df['product_id'].map(last_snapshots['pos']).fillna(-1)
+    after = df[(df['pos'] > last_snapshot_pos) & ~is_snapshot]
+    signed = after['quantity'] * after['change_type'].map(STOCK_EFFECTS).fillna(0).astype('int64')
+    deltas = signed.groupby(after['product_id']).sum()
+
+    base = last_snapshots['quantity'].combine_first(expected)
+    result = base.add(deltas, fill_value=0).astype('int64')
+    return result, has_snapshot | set(last_snapshots.index)
+
+
+def expected_stock():
+    """履歴から求めた在庫数と、スナップショットのある商品の集合を返します。
+
+    チェックポイント以降に追記された行だけを再生します。履歴が読み直された (行が削除・
+    編集された) 場合は最初から再生します。
+    """
+    records = database.get_history_records()
+    with _checkpoint_lock:
+        start = _checkpoint["rows"]
+        if start > len(records) or (start and str(records[start - 1].get('id')) != _checkpoint["last_id"]):
+            start = 0
+        if start:
+            expected, has_snapshot = replay(records[start:], _checkpoint["expected"], _checkpoint["has_snapshot"])
+        else:
+            expected, has_snapshot = replay(records)
+        _checkpoint.update(
+            rows=len(records), last_id=str(records[-1].get('id')) if records else None,
+            expected=expected, has_snapshot=has_snapshot,
+        )
+    return expected, has_snapshot
+
+
+def reconcile():
+    """商品ごとに current_stock と履歴から求めた在庫数を比べた表 (DataFrame) を返します。
+
+    列: id, product_code, name, current_stock, expected_stock, difference, has_snapshot
+    has_snapshot が False の商品は起点が無いため、expected_stock は履歴の合計でしかありません。
+    """
+    expected, has_snapshot = expected_stock()
+    products = pd.DataFrame(database.get_all_products(), columns=['id', 'product_code', 'name', 'current_stock'])
+    keys = products['id'].astype(str)
+    products['current_stock'] = pd.to_numeric(products['current_stock'], errors='coerce').fillna(0).astype('int64')
+    products['expected_stock'] = keys.map(expected).fillna(0).astype('int64')
+    products['difference'] = products['current_stock'] - products['expected_stock']
+    products['has_snapshot'] = keys.isin(has_snapshot)
+    return products
+
+
+def apply_corrections(report, user_name=''):
+    """reconcile() の結果のうち、起点があって差のある商品の在庫数を履歴どおりに直します。
+
+    修正はスナップショット行とともに1回のリクエストで書き込み、修正した商品数を返します。
+    """
+    targets = report[report['has_snapshot'] & (report['difference'] != 0)]
+    counts = dict(zip(targets['id'].tolist(), targets['expected_stock'].tolist()))
+    if counts:
+        database.set_stock_counts(counts, user_name)
+    return len(counts)
+
+
+def write_snapshots(user_name=''):
+    """現在の在庫数を全商品のスナップショットとして記録し、以降の検算の起点にします。"""
+    counts = {}
+    for product in database.get_all_products():
+        try:
+            counts[product['id']] = int(product['current_stock'])
+        except (ValueError, TypeError):
+            counts[product['id']] = 0
+    if counts:
+        database.set_stock_counts(counts, user_name)
+    return len(counts)
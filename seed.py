@@ -1,4 +1,7 @@
 #商品リストの登録
+import argparse
+import csv
+import yaml
 import database
 
 # 登録したい備品のリスト
@@ -63,19 +66,32 @@ products_to_seed = [
     {"code": "toel", "name": "キムタオル", "unit": "箱"},
 ]
 
-def seed_data():
-    print("備品データの初期登録を開始します...")
-    count = 0
-    for product in products_to_seed:
-        success = database.add_product(product["code"], product["name"], product["unit"])
-        if success:
-            print(f"  登録成功: {product['name']}")
-            count += 1
-        else:
-            print(f"  登録済み(スキップ): {product['name']}")
-            
-    print(f"\n{count}件の新しい備品を登録しました。")
+def load_products(path):
+    """CSV (code,name,unit の列見出し付き、任意で reorder_threshold) または YAML (辞書のリスト) から商品を読み込みます。"""
+    if path.lower().endswith(('.yaml', '.yml')):
+        with open(path, 'r', encoding='utf-8') as file:
+            data = yaml.safe_load(file) or []
+        # {"products": [...]} の形式も受け付ける
+        return data.get("products", []) if isinstance(data, dict) else data
+    with open(path, 'r', encoding='utf-8-sig', newline='') as file:
+        return list(csv.DictReader(file))
+
+def seed_data(products=None, dry_run=False):
+    print("備品データの初期登録を開始します..." + (" (dry-run: 書き込みは行いません)" if dry_run else ""))
+    result = database.add_products(products if products is not None else products_to_seed, dry_run=dry_run)
+    for product in result["inserted"]:
+        print(f"  登録{'予定' if dry_run else '成功'}: {product.get('name')} ({product.get('code')}, id={product['id']})")
+    for product in result["skipped"]:
+        print(f"  登録済み(スキップ): {product.get('name')} ({product.get('code') or product.get('product_code')})")
+
+    print(f"\n{len(result['inserted'])}件の新しい備品を{'登録できます' if dry_run else '登録しました'}。"
+          f"（スキップ {len(result['skipped'])}件）")
     print("初期登録を完了しました。")
+    return result
 
 if __name__ == '__main__':
-    seed_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="備品データを一括登録します。")
+    parser.add_argument('file', nargs='?', help="登録する商品の CSV / YAML ファイル (省略時は products_to_seed)")
+    parser.add_argument('--dry-run', action='store_true', help="書き込まずに、登録・スキップされる商品を表示する")
+    args = parser.parse_args()
+    seed_data(load_products(args.file) if args.file else None, dry_run=args.dry_run)
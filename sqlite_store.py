@@ -0,0 +1,314 @@
+# ==============================================================================
+# sqlite_store.py
+# ==============================================================================
+# ローカルの SQLite ファイルを使うストレージバックエンド。
+# database.py の公開関数と同じ名前・戻り値のメソッドを持ち、設定で storage_backend = "sqlite"
+# を選ぶと database.py からこちらが呼ばれる。スキャン・ログイン・履歴の検索はすべて
+# 索引付きのローカル検索になる。
+import sqlite3
+import threading
+from datetime import datetime
+import pytz
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    product_code TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    unit TEXT NOT NULL DEFAULT '',
+    current_stock INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT '',
+    reorder_threshold INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_products_code ON products (product_code);
+
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    hashed_password TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users (email);
+
+CREATE TABLE IF NOT EXISTS stock_history (
+    id INTEGER PRIMARY KEY,
+    product_id INTEGER,
+    user_name TEXT NOT NULL DEFAULT '',
+    change_type TEXT NOT NULL DEFAULT '',
+    quantity INTEGER NOT NULL DEFAULT 0,
+    timestamp TEXT NOT NULL,
+    misc_item_name TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_history_timestamp ON stock_history (timestamp);
+CREATE INDEX IF NOT EXISTS idx_history_product ON stock_history (product_id);
+"""
+
+PRODUCT_COLUMNS = ['id', 'product_code', 'name', 'unit', 'current_stock', 'created_at', 'reorder_threshold']
+USER_COLUMNS = ['name', 'email', 'hashed_password']
+HISTORY_COLUMNS = ['id', 'product_id', 'user_name', 'change_type', 'quantity', 'timestamp', 'misc_item_name']
+# 履歴の時刻は "YYYY-MM-DD HH:MM:SS" にそろえて保存し、期間の絞り込みは文字列の比較で行う
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+TIMESTAMP_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]"
+# シートから取り込んだ時刻に見られる書式 (スラッシュ区切り・秒なし・ゼロ埋めなしなど)
+TIMESTAMP_INPUT_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                           "%Y-%m-%d %H:%M", "%Y/%m/%d %H:%M", "%Y-%m-%d", "%Y/%m/%d")
+
+
+def _now_jst():
+    jst = pytz.timezone('Asia/Tokyo')
+    return datetime.now(jst).strftime(TIMESTAMP_FORMAT)
+
+
+def _normalize_timestamp(value):
+    """時刻を TIMESTAMP_FORMAT の文字列にそろえます。読めない値はそのまま返します。"""
+    text = str(value).strip()
+    for fmt in TIMESTAMP_INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime(TIMESTAMP_FORMAT)
+        except ValueError:
+            pass
+    return value
+
+
+class SqliteStore:
+    """SQLite ファイル1つに products / users / stock_history を持つバックエンド。"""
+
+    def __init__(self, path):
+        self.path = path
+        # 書き込みはプロセス内で直列化する (SQLite 自体もファイルロックで保護される)
+        self._write_lock = threading.Lock()
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+            # 発注点の列が無いころに作ったファイルには列を足す
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(products)")}
+            if 'reorder_threshold' not in columns:
+                conn.execute("ALTER TABLE products ADD COLUMN reorder_threshold INTEGER")
+            # 書式をそろえる前に取り込んだ履歴の時刻を直す
+            with conn:
+                conn.executemany("UPDATE stock_history SET timestamp = ? WHERE id = ?", [
+                    (_normalize_timestamp(row['timestamp']), row['id']) for row in conn.execute(
+                        "SELECT id, timestamp FROM stock_history WHERE timestamp NOT GLOB ?", (TIMESTAMP_GLOB,))
+                ])
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Streamlit はセッションごとに別スレッドで動くため、接続は呼び出しのたびに作る
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _query(self, sql, params=()):
+        conn = self._connect()
+        try:
+            return [dict(row) for row in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def _execute(self, statements):
+        """[(sql, params), ...] を1つのトランザクションで実行します。"""
+        with self._write_lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+            finally:
+                conn.close()
+
+    # --- ユーザー ---
+    def get_user(self, email):
+        rows = self._query("SELECT name, email, hashed_password FROM users WHERE email = ?", (str(email),))
+        return rows[0] if rows else None
+
+    def add_user(self, name, email, hashed_password):
+        self._execute([(
+            "INSERT INTO users (name, email, hashed_password) VALUES (?, ?, ?)",
+            (str(name), str(email), str(hashed_password)),
+        )])
+
+    # --- 商品 ---
+    def get_all_products(self):
+        return self._query(f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products ORDER BY id")
+
+    def get_product_by_code(self, product_code):
+        rows = self._query(
+            f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products WHERE product_code = ?", (str(product_code),)
+        )
+        return rows[0] if rows else None
+
+    def add_products(self, products, dry_run=False):
+        seen = {row['product_code'] for row in self._query("SELECT product_code FROM products")}
+        next_id = self._query("SELECT COALESCE(MAX(id), 0) AS max_id FROM products")[0]['max_id'] + 1
+        created_at = _now_jst()
+        statements, inserted, skipped = [], [], []
+        for product in products:
+            code = str(product.get("code") or product.get("product_code") or '').strip()
+            threshold = product.get('reorder_threshold')
+            if not code or code in seen:
+                skipped.append(product)
+                continue
+            seen.add(code)
+            statements.append((
+                f"INSERT INTO products ({', '.join(PRODUCT_COLUMNS)}) VALUES ({', '.join('?' for _ in PRODUCT_COLUMNS)})",
+                (next_id, code, product.get('name', ''), product.get('unit', ''),
+                 product.get('current_stock', 0), created_at, None if threshold in (None, '') else int(threshold)),
+            ))
+            inserted.append(dict(product, code=code, id=next_id))
+            next_id += 1
+        if statements and not dry_run:
+            self._execute(statements)
+        return {"inserted": inserted, "skipped": skipped}
+
+    def get_low_stock_products(self):
+        return self._query(
+            f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products"
+            " WHERE reorder_threshold IS NOT NULL AND current_stock <= reorder_threshold"
+            " ORDER BY current_stock - reorder_threshold"
+        )
+
+    def set_reorder_thresholds(self, thresholds):
+        self._execute([
+            ("UPDATE products SET reorder_threshold = ? WHERE id = ?",
+             (None if threshold is None or threshold == '' else int(threshold), product_id))
+            for product_id, threshold in thresholds.items()
+        ])
+
+    def update_stock(self, product_id, quantity_change):
+        self._execute([(
+            "UPDATE products SET current_stock = current_stock + ? WHERE id = ?",
+            (quantity_change, product_id),
+        )])
+
+    def set_stock_counts(self, counts, user_name=''):
+        from database import SNAPSHOT_CHANGE_TYPE
+        statements = []
+        for product_id, new_quantity in counts.items():
+            statements.append(("UPDATE products SET current_stock = ? WHERE id = ?", (new_quantity, product_id)))
+            statements.append(self._history_insert(product_id, user_name, SNAPSHOT_CHANGE_TYPE, new_quantity, ''))
+        self._execute(statements)
+
+    def set_stock_count(self, product_id, new_quantity, user_name=''):
+        self.set_stock_counts({product_id: new_quantity}, user_name)
+
+    def adjust_stock(self, product_id, quantity_change, user_name, change_type):
+        self._execute([
+            ("UPDATE products SET current_stock = current_stock + ? WHERE id = ?", (quantity_change, product_id)),
+            self._history_insert(product_id, user_name, change_type, abs(quantity_change), ''),
+        ])
+
+    def apply_stock_changes(self, changes, history_rows=(), on_batch=None):
+        statements = [
+            ("UPDATE products SET current_stock = current_stock + ? WHERE id = ?", (quantity_change, product_id))
+            for product_id, quantity_change in changes
+        ]
+        for history_id, product_id, user_name, change_type, quantity, timestamp, misc_item_name in history_rows:
+            statements.append((
+                f"INSERT OR IGNORE INTO stock_history ({', '.join(HISTORY_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (history_id, product_id if product_id != '' else None, user_name, change_type, quantity,
+                 _normalize_timestamp(timestamp), misc_item_name),
+            ))
+        self._execute(statements)
+        if on_batch:
+            on_batch([product_id for product_id, _ in changes])
+
+    # --- 履歴 ---
+    def _history_insert(self, product_id, user_name, change_type, quantity, misc_item_name):
+        return (
+            "INSERT INTO stock_history (product_id, user_name, change_type, quantity, timestamp, misc_item_name)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (product_id, user_name, change_type, quantity, _now_jst(), misc_item_name),
+        )
+
+    def add_stock_history(self, product_id, user_name, change_type, quantity):
+        self._execute([self._history_insert(product_id, user_name, change_type, quantity, '')])
+
+    def add_misc_stock_history(self, user_name, item_name, quantity):
+        self._execute([self._history_insert(None, user_name, 'その他使用', quantity, item_name)])
+
+    def get_history_records(self, refresh=True):
+        return self._query(
+            "SELECT id, COALESCE(product_id, '') AS product_id, user_name, change_type, quantity, timestamp,"
+            " misc_item_name FROM stock_history ORDER BY timestamp, id"
+        )
+
+    def get_all_history(self):
+        return self.get_history()
+
+    def get_history(self, limit=None, start_date=None, end_date=None, user_name=None, refresh=True):
+        conditions, params = [], []
+        if user_name:
+            conditions.append("h.user_name = ?")
+            params.append(str(user_name))
+        if start_date:
+            conditions.append("h.timestamp >= ?")
+            params.append(start_date.strftime("%Y-%m-%d"))
+        if end_date:
+            conditions.append("h.timestamp < date(?, '+1 day')")
+            params.append(end_date.strftime("%Y-%m-%d"))
+        sql = (
+            "SELECT h.id, COALESCE(h.product_id, '') AS product_id, h.user_name, h.change_type, h.quantity,"
+            " h.timestamp, h.misc_item_name, COALESCE(p.name, h.misc_item_name) AS name"
+            " FROM stock_history h LEFT JOIN products p ON p.id = h.product_id"
+        )
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY h.timestamp DESC, h.id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return self._query(sql, params)
+
+    def iter_history(self, start_date=None, end_date=None, product_ids=None, chunk_rows=5000):
+        """履歴を古い順に、品目名と商品コードを付けて chunk_rows 件ずつ (辞書のリストで) 返します。"""
+        conditions, params = [], []
+        if start_date:
+            conditions.append("h.timestamp >= ?")
+            params.append(start_date.strftime("%Y-%m-%d"))
+        if end_date:
+            conditions.append("h.timestamp < date(?, '+1 day')")
+            params.append(end_date.strftime("%Y-%m-%d"))
+        if product_ids:
+            product_ids = list(product_ids)
+            conditions.append(f"h.product_id IN ({', '.join('?' for _ in product_ids)})")
+            params.extend(product_ids)
+        sql = (
+            "SELECT h.id, h.timestamp, COALESCE(h.product_id, '') AS product_id,"
+            " COALESCE(p.product_code, '') AS product_code, COALESCE(p.name, h.misc_item_name) AS name,"
+            " h.user_name, h.change_type, h.quantity, h.misc_item_name"
+            " FROM stock_history h LEFT JOIN products p ON p.id = h.product_id"
+        )
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY h.timestamp, h.id"
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield [dict(row) for row in rows]
+        finally:
+            conn.close()
+
+    # --- スプレッドシートからの取り込み ---
+    def replace_all(self, products, users, history):
+        """各テーブルの中身を、シートから読み込んだレコード (辞書のリスト) で置き換えます。"""
+        statements = [("DELETE FROM products", ()), ("DELETE FROM users", ()), ("DELETE FROM stock_history", ())]
+        for table, columns, records in (
+            ("products", PRODUCT_COLUMNS, products),
+            ("users", USER_COLUMNS, users),
+            ("stock_history", HISTORY_COLUMNS, history),
+        ):
+            sql = f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+            for record in records:
+                values = [record.get(c, '') for c in columns]
+                # 空欄の ID は NULL として入れる (id は自動採番、product_id は「その他」の品目)。発注点の空欄も NULL
+                values = [None if v == '' and c in ('id', 'product_id', 'reorder_threshold') else v
+                          for c, v in zip(columns, values)]
+                if table == "stock_history":
+                    values[columns.index('timestamp')] = _normalize_timestamp(values[columns.index('timestamp')])
+                statements.append((sql, values))
+        self._execute(statements)